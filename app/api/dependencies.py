@@ -1,17 +1,19 @@
+from functools import lru_cache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
 from app.core.security import decode_access_token
-from app.schemas.user import TokenData
+from app.schemas.user import TokenData, CurrentUser
 from app.models.user import User, UserRole
 from app.crud import user as crud_user
+from app.core.cache import cache_get, cache_set
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/v1/auth/login")
 
-def get_current_user(
-    db: Session = Depends(get_db),
+async def get_current_user(
+    db: AsyncSession = Depends(get_db),
     token: str = Depends(oauth2_scheme)
 ) -> User:
     credentials_exception = HTTPException(
@@ -29,20 +31,57 @@ def get_current_user(
         raise credentials_exception
     
     token_data = TokenData(username=username)
-    user = crud_user.get_user_by_username(db, username=token_data.username)
+    user = await crud_user.get_user_by_username(db, username=token_data.username)
     
     if user is None or not user.is_active:
         raise credentials_exception
     
     return user
 
-def get_current_active_user(current_user: User = Depends(get_current_user)):
-    if not current_user.is_active:
-        raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
+async def _is_user_active(db: AsyncSession, user_id: int, username: str):
+    """Флаг is_active с коротким кэшем; None, если пользователь удален"""
+    cache_key = f"user:{user_id}:{username}:active"
+    is_active = await cache_get(cache_key)
+    if is_active is None:
+        is_active = await crud_user.get_user_is_active(db, user_id=user_id, username=username)
+        if is_active is not None:
+            await cache_set(cache_key, is_active, expire=60)
+    return is_active
 
+async def get_current_active_user(
+    db: AsyncSession = Depends(get_db),
+    token: str = Depends(oauth2_scheme)
+) -> CurrentUser:
+    """Пользователь из claims токена, без загрузки строки users.
+    Для полной модели пользователя используйте get_current_user"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    
+    payload = decode_access_token(token)
+    if payload is None:
+        raise credentials_exception
+    
+    username = payload.get("sub")
+    user_id = payload.get("user_id")
+    role = payload.get("role")
+    if username is None or user_id is None or role is None:
+        raise credentials_exception
+    
+    # Роль берется из токена, в БД (или кэше) проверяется только активность
+    is_active = await _is_user_active(db, user_id, username)
+    if not is_active:
+        raise credentials_exception
+    
+    return CurrentUser(id=user_id, username=username, role=role, is_active=is_active)
+
+@lru_cache(maxsize=None)
 def require_role(required_role: UserRole):
-    def role_checker(current_user: User = Depends(get_current_active_user)):
+    """Зависимость проверки роли. Для одной роли возвращается один и тот же объект,
+    а проверка асинхронная и не уходит в пул потоков"""
+    async def role_checker(current_user: CurrentUser = Depends(get_current_active_user)):
         if current_user.role != required_role and current_user.role != UserRole.ADMIN:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
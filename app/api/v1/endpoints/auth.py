@@ -1,27 +1,27 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 from app.database import get_db
 from app.schemas.user import Token, UserCreate, UserResponse
 from app.crud import user as crud_user
 from app.core.security import create_access_token, get_password_hash
 from app.config import settings
-from app.api.dependencies import get_current_active_user  # ИЗМЕНЕНИЕ: Импортируем из dependencies
+from app.api.dependencies import get_current_user  # ИЗМЕНЕНИЕ: Импортируем из dependencies
 
 router = APIRouter()
 
 @router.post("/register", response_model=UserResponse)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     # Проверяем, существует ли пользователь
-    db_user = crud_user.get_user_by_email(db, email=user.email)
+    db_user = await crud_user.get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
     
-    db_user = crud_user.get_user_by_username(db, username=user.username)
+    db_user = await crud_user.get_user_by_username(db, username=user.username)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -29,14 +29,14 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Создаем пользователя
-    return crud_user.create_user(db=db, user=user)
+    return await crud_user.create_user(db=db, user=user)
 
 @router.post("/login", response_model=Token)
 async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = crud_user.authenticate_user(
+    user = await crud_user.authenticate_user(
         db, 
         username=form_data.username, 
         password=form_data.password
@@ -58,5 +58,5 @@ async def login(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.get("/me", response_model=UserResponse)
-async def read_users_me(current_user = Depends(get_current_active_user)):  # ИЗМЕНЕНИЕ: Используем из dependencies
+async def read_users_me(current_user = Depends(get_current_user)):  # Нужна полная модель пользователя
     return current_user
\ No newline at end of file
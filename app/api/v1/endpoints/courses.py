@@ -1,27 +1,44 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
+import asyncio
 from app.database import get_db
 from app.schemas.course import CourseCreate, CourseUpdate, CourseResponse, CourseEnrollmentResponse
 from app.crud import course as crud_course
 from app.api.dependencies import get_current_active_user, require_role
 from app.models.user import User, UserRole
 from app.services.file_service import FileService
+from app.services.quiz_service import QuizService
+from app.crud import lesson as crud_lesson
+from app.core.cache import cache_get, cache_set, cache_delete, invalidate_course, invalidate_lessons, invalidate_quiz
+from app.core.etag import compute_etag, etag_matches, not_modified
 
 router = APIRouter()
 file_service = FileService()
 
+async def _raise_course_write_denied(db: AsyncSession, course_id: int, detail: str):
+    """После неудачной записи отличает отсутствующий курс (404) от чужого (403)"""
+    if await crud_course.get_course(db, course_id=course_id):
+        raise HTTPException(status_code=403, detail=detail)
+    raise HTTPException(status_code=404, detail="Course not found")
+
 @router.get("/", response_model=List[CourseResponse])
 async def read_courses(
     skip: int = 0,
     limit: int = 100,
     author_id: Optional[int] = None,
     published_only: bool = True,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить список курсов"""
-    courses = crud_course.get_courses(
+    cache_key = f"courses:list:{skip}:{limit}:{author_id}:{published_only}"
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        return ORJSONResponse(cached)
+    
+    rows = await crud_course.get_course_list_rows(
         db, 
         skip=skip, 
         limit=limit, 
@@ -29,117 +46,126 @@ async def read_courses(
         published_only=published_only
     )
     
-    # Преобразуем в response с дополнительными полями
-    response_courses = []
-    for course in courses:
-        course_dict = CourseResponse.from_orm(course)
-        course_dict.lesson_count = len(course.lessons)
-        course_dict.author_name = course.author.full_name
-        response_courses.append(course_dict)
+    # Данные из БД уже проверены: строки отдаются напрямую, минуя валидацию response_model
+    response_courses = [dict(row) for row in rows]
     
-    return response_courses
+    await cache_set(cache_key, response_courses)
+    return ORJSONResponse(response_courses)
 
 @router.get("/my-courses", response_model=List[CourseResponse])
 async def read_my_courses(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить курсы текущего пользователя (как автор или студент)"""
     if current_user.role == UserRole.AUTHOR or current_user.role == UserRole.ADMIN:
         # Курсы, где пользователь автор
-        courses = crud_course.get_courses(db, author_id=current_user.id, published_only=False)
+        rows = await crud_course.get_course_list_rows(db, author_id=current_user.id, published_only=False)
     else:
         # Курсы, на которые записан студент
-        enrollments = crud_course.get_user_enrollments(db, current_user.id)
-        courses = [enrollment.course for enrollment in enrollments]
-    
-    response_courses = []
-    for course in courses:
-        course_dict = CourseResponse.from_orm(course)
-        course_dict.lesson_count = len(course.lessons)
-        course_dict.author_name = course.author.full_name
-        response_courses.append(course_dict)
+        rows = await crud_course.get_enrolled_course_rows(db, current_user.id)
     
-    return response_courses
+    return ORJSONResponse([dict(row) for row in rows])
 
 @router.get("/{course_id}", response_model=CourseResponse)
 async def read_course(
     course_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить курс по ID"""
-    course = crud_course.get_course(db, course_id=course_id)
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
+    cache_key = f"course:{course_id}"
+    entry = await cache_get(cache_key)
+    if entry is None:
+        course = await crud_course.get_course_with_details(db, course_id=course_id)
+        if not course:
+            raise HTTPException(status_code=404, detail="Course not found")
+        
+        course_dict = CourseResponse.model_validate(course).model_copy(
+            update={"author_name": course.author.full_name}
+        ).model_dump()
+        entry = {"etag": compute_etag(course_dict), "data": course_dict}
+        await cache_set(cache_key, entry)
+    
+    course_dict = entry["data"]
     
     # Проверяем доступ
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
+    if not course_dict["is_published"] and course_dict["author_id"] != current_user.id and current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Not authorized to view this course")
     
-    course_dict = CourseResponse.from_orm(course)
-    course_dict.lesson_count = len(course.lessons)
-    course_dict.author_name = course.author.full_name
+    if etag_matches(request, entry["etag"]):
+        return not_modified(entry["etag"])
     
-    return course_dict
+    return ORJSONResponse(course_dict, headers={"ETag": entry["etag"]})
 
 @router.post("/", response_model=CourseResponse)
 async def create_course(
     course: CourseCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_role(UserRole.AUTHOR))
 ):
     """Создать новый курс (только для авторов)"""
-    return crud_course.create_course(db=db, course=course, author_id=current_user.id)
+    db_course = await crud_course.create_course(db=db, course=course, author_id=current_user.id)
+    await cache_delete("courses:*")
+    return db_course
 
 @router.put("/{course_id}", response_model=CourseResponse)
 async def update_course(
     course_id: int,
     course_update: CourseUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Обновить курс"""
-    course = crud_course.get_course(db, course_id=course_id)
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-    
-    # Проверяем права
-    if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to update this course")
-    
-    updated_course = crud_course.update_course(db, course_id=course_id, course_update=course_update)
+    # Права проверяются в самом UPDATE
+    updated_course = await crud_course.update_owned_course(
+        db,
+        course_id=course_id,
+        course_update=course_update,
+        user_id=current_user.id,
+        is_admin=current_user.role == UserRole.ADMIN
+    )
     if not updated_course:
-        raise HTTPException(status_code=404, detail="Course not found")
+        await _raise_course_write_denied(db, course_id, "Not authorized to update this course")
     
+    await invalidate_course(course_id)
     return updated_course
 
 @router.delete("/{course_id}")
 async def delete_course(
     course_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Удалить курс"""
-    course = crud_course.get_course(db, course_id=course_id)
-    if not course:
-        raise HTTPException(status_code=404, detail="Course not found")
-    
-    # Проверяем права
-    if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to delete this course")
+    # Уроки и их тесты удаляются каскадом, их ключи в кэше нужно сбросить отдельно
+    lesson_ids = await crud_lesson.get_lesson_ids_by_course(db, course_id=course_id)
+    quiz_keys = await QuizService(db).get_quiz_keys_by_lessons(lesson_ids)
+    deleted_course = await crud_course.delete_owned_course(
+        db,
+        course_id=course_id,
+        user_id=current_user.id,
+        is_admin=current_user.role == UserRole.ADMIN
+    )
+    if not deleted_course:
+        await _raise_course_write_denied(db, course_id, "Not authorized to delete this course")
     
-    crud_course.delete_course(db, course_id=course_id)
+    await asyncio.gather(
+        invalidate_course(course_id),
+        invalidate_lessons(lesson_ids),
+        *[invalidate_quiz(quiz_id, lesson_id) for quiz_id, lesson_id in quiz_keys]
+    )
     return {"message": "Course deleted successfully"}
 
 @router.post("/{course_id}/enroll", response_model=CourseEnrollmentResponse)
 async def enroll_in_course(
     course_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Записаться на курс"""
-    course = crud_course.get_course(db, course_id=course_id)
+    course = await crud_course.get_course(db, course_id=course_id)
     if not course or not course.is_published:
         raise HTTPException(status_code=404, detail="Course not found or not published")
     
@@ -147,18 +173,18 @@ async def enroll_in_course(
     if course.author_id == current_user.id:
         raise HTTPException(status_code=400, detail="Author cannot enroll in their own course")
     
-    enrollment = crud_course.enroll_student(db, course_id=course_id, student_id=current_user.id)
+    enrollment = await crud_course.enroll_student(db, course_id=course_id, student_id=current_user.id)
     return enrollment
 
 @router.post("/{course_id}/upload-thumbnail")
 async def upload_thumbnail(
     course_id: int,
     file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Загрузить обложку для курса"""
-    course = crud_course.get_course(db, course_id=course_id)
+    course = await crud_course.get_course(db, course_id=course_id)
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
@@ -173,7 +199,7 @@ async def upload_thumbnail(
     
     # Обновляем курс
     course.thumbnail_url = str(file_path)
-    db.commit()
-    db.refresh(course)
+    await db.commit()
+    await invalidate_course(course_id)
     
     return {"thumbnail_url": str(file_path)}
\ No newline at end of file
@@ -1,8 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Response
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Request, Response
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from pathlib import Path
+import asyncio
 import os
+import aiofiles
+import anyio
+from cachetools import LRUCache
 from app.database import get_db
 from app.schemas.lesson import LessonCreate, LessonUpdate, LessonResponse, LessonAttachmentCreate, LessonAttachmentResponse
 from app.crud import lesson as crud_lesson
@@ -11,105 +16,214 @@ from app.api.dependencies import get_current_active_user, require_role
 from app.models.user import User, UserRole
 from app.services.file_service import FileService
 from app.services.markdown_service import MarkdownService
+from app.services.quiz_service import QuizService
 from app.config import settings
+from app.core.cache import cache_get, cache_set, cache_delete, invalidate_course, invalidate_lesson, invalidate_quiz
+from app.core.etag import compute_etag, etag_matches, not_modified
 
 router = APIRouter()
 file_service = FileService()
 markdown_service = MarkdownService()
 
+_URL_PREFIXES = ('http://', 'https://')
+
+# Типы файлов, которые можно предпросматривать
+_PREVIEWABLE_MIME_TYPES = frozenset({
+    'image/jpeg', 'image/png', 'image/gif', 'image/bmp', 'image/webp', 'image/svg+xml',
+    'application/pdf',
+    'text/plain', 'text/html', 'text/markdown', 'text/css', 'application/javascript',
+    'application/json', 'application/xml'
+})
+_TEXT_APPLICATION_MIME_TYPES = frozenset({'application/json', 'application/xml'})
+
+# Содержимое текстовых превью по (attachment_id, mtime); размер кэша ограничен в символах
+_preview_cache = LRUCache(maxsize=settings.PREVIEW_CACHE_SIZE, getsizeof=len)
+
+async def _get_course_access(db: AsyncSession, course_id: int) -> Optional[dict]:
+    """Данные курса для проверки доступа (автор и публикация), с кэшем"""
+    cache_key = f"course:{course_id}:access"
+    access = await cache_get(cache_key)
+    if access is None:
+        course = await crud_course.get_course(db, course_id=course_id)
+        if not course:
+            return None
+        access = {"author_id": course.author_id, "is_published": course.is_published}
+        await cache_set(cache_key, access)
+    return access
+
+async def _stat_local_file(file_path: Path) -> Optional[os.stat_result]:
+    """stat() в пуле потоков, чтобы не блокировать event loop; None, если файла нет"""
+    try:
+        return await anyio.to_thread.run_sync(file_path.stat)
+    except OSError:
+        return None
+
+def _media_url(attachment) -> Optional[str]:
+    """URL файла на CDN, если он настроен (CDN зеркалирует каталог /uploads)"""
+    if settings.MEDIA_BASE_URL and attachment.file_url and attachment.file_url.startswith('/uploads/'):
+        return f"{settings.MEDIA_BASE_URL.rstrip('/')}{attachment.file_url}"
+    return None
+
+def _authorize_course_access(
+    author_id: int,
+    is_published: bool,
+    user: User,
+    write: bool = False,
+    detail: str = "Not authorized"
+):
+    """Чтение доступно для опубликованных курсов, изменение - только автору курса или админу"""
+    if author_id == user.id or user.role == UserRole.ADMIN:
+        return
+    if not write and is_published:
+        return
+    raise HTTPException(status_code=403, detail=detail)
+
+async def _get_authorized_lesson(
+    db: AsyncSession,
+    lesson_id: int,
+    user: User,
+    write: bool = False,
+    detail: str = "Not authorized"
+):
+    """Урок и права на его курс одним запросом"""
+    row = await crud_lesson.get_lesson_with_course_perms(db, lesson_id=lesson_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Lesson not found")
+    
+    lesson, author_id, is_published = row
+    _authorize_course_access(author_id, is_published, user, write=write, detail=detail)
+    return lesson
+
+async def _raise_lesson_write_denied(db: AsyncSession, lesson_id: int, user: User, detail: str):
+    """После неудачной записи отличает отсутствующий урок (404) от чужого (403)"""
+    await _get_authorized_lesson(db, lesson_id, user, write=True, detail=detail)
+    raise HTTPException(status_code=404, detail="Lesson not found")
+
 @router.get("/course/{course_id}", response_model=List[LessonResponse])
 async def read_lessons(
     course_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить все уроки курса"""
-    course = crud_course.get_course(db, course_id=course_id)
-    if not course:
+    access = await _get_course_access(db, course_id)
+    if not access:
         raise HTTPException(status_code=404, detail="Course not found")
     
     # Проверяем доступ
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to view lessons")
+    _authorize_course_access(
+        access["author_id"], access["is_published"], current_user, detail="Not authorized to view lessons"
+    )
     
-    lessons = crud_lesson.get_lessons_by_course(db, course_id=course_id)
-    return lessons
+    cache_key = f"course:{course_id}:lessons"
+    lessons = await cache_get(cache_key)
+    if lessons is None:
+        db_lessons = await crud_lesson.get_lessons_by_course(db, course_id=course_id)
+        lessons = [LessonResponse.model_validate(lesson).model_dump() for lesson in db_lessons]
+        await cache_set(cache_key, lessons)
+    
+    # Словари уже соответствуют схеме: отдаем их напрямую, минуя повторную валидацию response_model
+    return ORJSONResponse(lessons)
 
 @router.get("/{lesson_id}", response_model=LessonResponse)
 async def read_lesson(
     lesson_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить урок по ID"""
-    lesson = crud_lesson.get_lesson_with_attachments(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
+    cache_key = f"lesson:{lesson_id}"
+    entry = await cache_get(cache_key)
+    if entry is None:
+        row = await crud_lesson.get_lesson_with_course_perms(db, lesson_id=lesson_id, with_attachments=True)
+        if not row:
+            raise HTTPException(status_code=404, detail="Lesson not found")
+        db_lesson, author_id, is_published = row
+        access = {"author_id": author_id, "is_published": is_published}
+        lesson = LessonResponse.model_validate(db_lesson).model_dump()
+        entry = {"etag": compute_etag(lesson), "data": lesson}
+        await cache_set(cache_key, entry)
+    else:
+        access = await _get_course_access(db, entry["data"]["course_id"])
+        if access is None:
+            # Курс удален, а запись урока в кэше устарела
+            await cache_delete(cache_key)
+            raise HTTPException(status_code=404, detail="Lesson not found")
     
     # Проверяем доступ к курсу
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to view this lesson")
+    _authorize_course_access(
+        access["author_id"], access["is_published"], current_user, detail="Not authorized to view this lesson"
+    )
     
-    return lesson
+    if etag_matches(request, entry["etag"]):
+        return not_modified(entry["etag"])
+    
+    return ORJSONResponse(entry["data"], headers={"ETag": entry["etag"]})
 
 @router.post("/", response_model=LessonResponse)
 async def create_lesson(
     lesson: LessonCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_role(UserRole.AUTHOR))
 ):
     """Создать новый урок"""
     # Проверяем, что курс существует и пользователь автор
-    course = crud_course.get_course(db, course_id=lesson.course_id)
+    course = await crud_course.get_course(db, course_id=lesson.course_id)
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
     if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Not authorized to add lessons to this course")
     
-    return crud_lesson.create_lesson(db=db, lesson=lesson)
+    db_lesson = await crud_lesson.create_lesson(db=db, lesson=lesson)
+    await invalidate_course(lesson.course_id)
+    return db_lesson
 
 @router.put("/{lesson_id}", response_model=LessonResponse)
 async def update_lesson(
     lesson_id: int,
     lesson_update: LessonUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Обновить урок"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
-    
-    # Проверяем права
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to update this lesson")
-    
-    updated_lesson = crud_lesson.update_lesson(db, lesson_id=lesson_id, lesson_update=lesson_update)
+    # Права проверяются в самом UPDATE
+    updated_lesson = await crud_lesson.update_owned_lesson(
+        db,
+        lesson_id=lesson_id,
+        lesson_update=lesson_update,
+        user_id=current_user.id,
+        is_admin=current_user.role == UserRole.ADMIN
+    )
     if not updated_lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
+        await _raise_lesson_write_denied(db, lesson_id, current_user, "Not authorized to update this lesson")
     
+    await invalidate_lesson(lesson_id, updated_lesson.course_id)
     return updated_lesson
 
 @router.delete("/{lesson_id}")
 async def delete_lesson(
     lesson_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Удалить урок"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
-    
-    # Проверяем права
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to delete this lesson")
+    # Тест удаляется каскадом в БД, его ключ в кэше нужно сбросить отдельно
+    quiz_keys = await QuizService(db).get_quiz_keys_by_lessons([lesson_id])
+    deleted_lesson = await crud_lesson.delete_owned_lesson(
+        db,
+        lesson_id=lesson_id,
+        user_id=current_user.id,
+        is_admin=current_user.role == UserRole.ADMIN
+    )
+    if not deleted_lesson:
+        await _raise_lesson_write_denied(db, lesson_id, current_user, "Not authorized to delete this lesson")
     
-    crud_lesson.delete_lesson(db, lesson_id=lesson_id)
+    await asyncio.gather(
+        invalidate_lesson(lesson_id, deleted_lesson.course_id),
+        *[invalidate_quiz(quiz_id, quiz_lesson_id) for quiz_id, quiz_lesson_id in quiz_keys]
+    )
     return {"message": "Lesson deleted successfully"}
 
 @router.post("/{lesson_id}/upload-attachment", response_model=LessonAttachmentResponse)
@@ -118,18 +232,11 @@ async def upload_attachment(
     file: UploadFile = File(...),
     is_video: bool = Form(False),
     video_url: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Загрузить вложение для урока"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
-    
-    # Проверяем права
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    lesson = await _get_authorized_lesson(db, lesson_id, current_user, write=True, detail="Not authorized")
     
     attachment_data = {}
     
@@ -149,12 +256,12 @@ async def upload_attachment(
         }
     else:
         # Загрузка обычного файла
-        file_path = await file_service.save_upload_file(file, subdir=f"lessons/{lesson_id}")
-        if not file_path:
+        saved = await file_service.save_upload_file_with_size(file, subdir=f"lessons/{lesson_id}")
+        if not saved:
             raise HTTPException(status_code=500, detail="Failed to save file")
         
-        mime_type = file_service.get_file_mime_type(file_path)
-        file_size = file_service.get_file_size(file_path)
+        file_path, file_size = saved
+        mime_type = await file_service.get_file_mime_type_async(file_path)
         
         attachment_data = {
             "file_name": file.filename or str(file_path.name),
@@ -171,144 +278,163 @@ async def upload_attachment(
         **attachment_data
     )
     
-    return crud_lesson.create_attachment(db, attachment_create)
+    attachment = await crud_lesson.create_attachment(db, attachment_create)
+    await invalidate_lesson(lesson_id, lesson.course_id)
+    return attachment
+
+@router.post("/{lesson_id}/upload-attachments", response_model=List[LessonAttachmentResponse])
+async def upload_attachments(
+    lesson_id: int,
+    files: List[UploadFile] = File(...),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Загрузить несколько вложений для урока"""
+    lesson = await _get_authorized_lesson(db, lesson_id, current_user, write=True, detail="Not authorized")
+    
+    # Файлы сохраняются параллельно; размер считается при записи
+    saved_files = await asyncio.gather(*[
+        file_service.save_upload_file_with_size(file, subdir=f"lessons/{lesson_id}") for file in files
+    ])
+    if not all(saved_files):
+        for saved in saved_files:
+            if saved:
+                file_service.delete_file(str(saved[0]))
+        raise HTTPException(status_code=500, detail="Failed to save file")
+    
+    file_paths, file_sizes = zip(*saved_files)
+    
+    # MIME-типы всех файлов тоже определяются параллельно
+    mime_types = await asyncio.gather(*[
+        file_service.get_file_mime_type_async(file_path) for file_path in file_paths
+    ])
+    
+    attachments_create = []
+    for file, file_path, mime_type, file_size in zip(files, file_paths, mime_types, file_sizes):
+        attachments_create.append(LessonAttachmentCreate(
+            lesson_id=lesson_id,
+            file_name=file.filename or str(file_path.name),
+            file_path=str(file_path),
+            file_size=file_size,
+            mime_type=mime_type,
+            is_video=mime_type.startswith('video/'),
+            video_provider="uploaded" if mime_type.startswith('video/') else None
+        ))
+    
+    # Все записи создаются одним INSERT
+    attachments = await crud_lesson.create_attachments(db, attachments_create)
+    await invalidate_lesson(lesson_id, lesson.course_id)
+    return attachments
 
 @router.post("/{lesson_id}/markdown-preview")
 async def preview_markdown(
     lesson_id: int,
     markdown_content: str = Form(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Предпросмотр Markdown контента"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
-    
-    # Проверяем права
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    await _get_authorized_lesson(db, lesson_id, current_user, write=True, detail="Not authorized")
     
-    # Конвертируем Markdown в HTML
-    html_content = markdown_service.convert_to_html(markdown_content)
+    # Конвертируем Markdown в HTML; одинаковый текст при частых превью берем из кэша
+    cache_key = "md:" + markdown_service.content_hash(markdown_content)
+    html_content = await cache_get(cache_key)
+    if html_content is None:
+        html_content = await markdown_service.convert_to_html_async(markdown_content)
+        await cache_set(cache_key, html_content, expire=600)
     
     return {"html_content": html_content}
 
 @router.get("/{lesson_id}/attachments", response_model=List[LessonAttachmentResponse])
 async def get_lesson_attachments(
     lesson_id: int,
+    request: Request,
     file_type: Optional[str] = None,  # 'image', 'video', 'document'
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить все вложения урока"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
+    await _get_authorized_lesson(db, lesson_id, current_user, detail="Not authorized to view attachments")
     
-    # Проверяем доступ к курсу
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to view attachments")
+    cache_key = f"lesson:{lesson_id}:attachments:{file_type or 'all'}"
+    entry = await cache_get(cache_key)
+    if entry is None:
+        rows = await crud_lesson.get_attachment_rows(db, lesson_id=lesson_id, file_type=file_type)
     
-    if file_type:
-        attachments = crud_lesson.get_attachments_by_type(db, lesson_id=lesson_id, file_type=file_type)
-    else:
-        attachments = crud_lesson.get_attachments(db, lesson_id=lesson_id)
+        # Данные из БД уже проверены, поэтому собираем ответ без валидации
+        response_attachments = [
+            LessonAttachmentResponse.model_construct(**row).model_dump() for row in rows
+        ]
+        entry = {"etag": compute_etag(response_attachments), "data": response_attachments}
+        await cache_set(cache_key, entry)
     
-    # Преобразуем пути в URL
-    response_attachments = []
-    for attachment in attachments:
-        attachment_dict = LessonAttachmentResponse.from_orm(attachment)
-        
-        # Преобразуем локальный путь в URL
-        if attachment.file_path and not attachment.file_path.startswith(('http://', 'https://')):
-            # Если это локальный файл, преобразуем путь в URL
-            try:
-                # Относительный путь от базовой директории загрузок
-                rel_path = os.path.relpath(attachment.file_path, settings.UPLOAD_DIR)
-                attachment_dict.file_url = f"/uploads/{rel_path.replace(os.path.sep, '/')}"
-            except ValueError:
-                # Если путь не внутри UPLOAD_DIR, оставляем как есть
-                attachment_dict.file_url = attachment.file_path
-        else:
-            # Если это URL (например, Rutube), оставляем как есть
-            attachment_dict.file_url = attachment.file_path
-        
-        response_attachments.append(attachment_dict)
+    if etag_matches(request, entry["etag"]):
+        return not_modified(entry["etag"])
     
-    return response_attachments
+    return ORJSONResponse(entry["data"], headers={"ETag": entry["etag"]})
 
 @router.get("/{lesson_id}/attachments/{attachment_id}", response_model=LessonAttachmentResponse)
 async def get_lesson_attachment(
     lesson_id: int,
     attachment_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить информацию о конкретном вложении"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
-    
-    # Проверяем доступ к курсу
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to view attachment")
+    await _get_authorized_lesson(db, lesson_id, current_user, detail="Not authorized to view attachment")
     
-    attachment = crud_lesson.get_attachment(db, attachment_id=attachment_id)
+    attachment = await crud_lesson.get_attachment(db, attachment_id=attachment_id)
     if not attachment or attachment.lesson_id != lesson_id:
         raise HTTPException(status_code=404, detail="Attachment not found")
     
-    # Преобразуем путь в URL
-    attachment_dict = LessonAttachmentResponse.from_orm(attachment)
-    
-    if attachment.file_path and not attachment.file_path.startswith(('http://', 'https://')):
-        try:
-            rel_path = os.path.relpath(attachment.file_path, settings.UPLOAD_DIR)
-            attachment_dict.file_url = f"/uploads/{rel_path.replace(os.path.sep, '/')}"
-        except ValueError:
-            attachment_dict.file_url = attachment.file_path
-    else:
-        attachment_dict.file_url = attachment.file_path
-    
-    return attachment_dict
+    return attachment
 
 @router.get("/{lesson_id}/attachments/{attachment_id}/download")
 async def download_lesson_attachment(
     lesson_id: int,
     attachment_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Скачать файл вложения"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
+    await _get_authorized_lesson(db, lesson_id, current_user, detail="Not authorized to download attachment")
     
-    # Проверяем доступ к курсу
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to download attachment")
-    
-    attachment = crud_lesson.get_attachment(db, attachment_id=attachment_id)
+    attachment = await crud_lesson.get_attachment(db, attachment_id=attachment_id)
     if not attachment or attachment.lesson_id != lesson_id:
         raise HTTPException(status_code=404, detail="Attachment not found")
     
     # Проверяем тип файла
-    if attachment.file_path.startswith(('http://', 'https://')):
+    if attachment.file_path.startswith(_URL_PREFIXES):
         # Если это внешний URL (например, Rutube), перенаправляем
         from fastapi.responses import RedirectResponse
         return RedirectResponse(url=attachment.file_path)
     
+    # Файл отдается с CDN, воркер только проверяет права
+    media_url = _media_url(attachment)
+    if media_url:
+        from fastapi.responses import RedirectResponse
+        return RedirectResponse(url=media_url)
+    
     # Проверяем существование файла
     file_path = Path(attachment.file_path)
-    if not file_path.exists():
+    file_stat = await _stat_local_file(file_path)
+    if file_stat is None:
         raise HTTPException(status_code=404, detail="File not found on server")
     
     # Определяем Content-Type
     media_type = attachment.mime_type or "application/octet-stream"
+    content_disposition = f"attachment; filename={attachment.file_name}"
+    
+    if settings.X_ACCEL_REDIRECT_PREFIX:
+        # Файл отдает nginx через sendfile, воркер освобождается сразу
+        rel_path = os.path.relpath(file_path, settings.UPLOAD_DIR).replace(os.path.sep, '/')
+        return Response(
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": f"{settings.X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{rel_path}",
+                "Content-Disposition": content_disposition
+            }
+        )
     
     # Отправляем файл
     from fastapi.responses import FileResponse
@@ -317,66 +443,69 @@ async def download_lesson_attachment(
         filename=attachment.file_name,
         media_type=media_type,
         headers={
-            "Content-Disposition": f"attachment; filename={attachment.file_name}"
-        }
+            "Content-Disposition": content_disposition
+        },
+        stat_result=file_stat
     )
 
 @router.get("/{lesson_id}/attachments/{attachment_id}/preview")
 async def preview_lesson_attachment(
     lesson_id: int,
     attachment_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Предпросмотр файла вложения (для изображений, PDF и т.д.)"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
+    await _get_authorized_lesson(db, lesson_id, current_user, detail="Not authorized to preview attachment")
     
-    # Проверяем доступ к курсу
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to preview attachment")
-    
-    attachment = crud_lesson.get_attachment(db, attachment_id=attachment_id)
+    attachment = await crud_lesson.get_attachment(db, attachment_id=attachment_id)
     if not attachment or attachment.lesson_id != lesson_id:
         raise HTTPException(status_code=404, detail="Attachment not found")
     
     # Проверяем, можно ли предпросматривать этот тип файла
-    previewable_types = [
-        'image/jpeg', 'image/png', 'image/gif', 'image/bmp', 'image/webp', 'image/svg+xml',
-        'application/pdf',
-        'text/plain', 'text/html', 'text/markdown', 'text/css', 'application/javascript',
-        'application/json', 'application/xml'
-    ]
-    
-    if attachment.mime_type not in previewable_types:
+    if attachment.mime_type not in _PREVIEWABLE_MIME_TYPES:
         raise HTTPException(
             status_code=400, 
             detail="This file type cannot be previewed. Please download it instead."
         )
     
-    if attachment.file_path.startswith(('http://', 'https://')):
+    if attachment.file_path.startswith(_URL_PREFIXES):
         from fastapi.responses import RedirectResponse
         return RedirectResponse(url=attachment.file_path)
     
+    # Изображения и PDF отдаются с CDN; текстовые файлы читаются здесь
+    is_text = attachment.mime_type.startswith('text/') or attachment.mime_type in _TEXT_APPLICATION_MIME_TYPES
+    media_url = _media_url(attachment)
+    if media_url and not is_text:
+        from fastapi.responses import RedirectResponse
+        return RedirectResponse(url=media_url)
+    
     file_path = Path(attachment.file_path)
-    if not file_path.exists():
+    file_stat = await _stat_local_file(file_path)
+    if file_stat is None:
         raise HTTPException(status_code=404, detail="File not found on server")
     
     # Для текстовых файлов читаем содержимое
-    if attachment.mime_type.startswith('text/') or attachment.mime_type in [
-        'application/json', 'application/xml'
-    ]:
+    if is_text:
+        if file_stat.st_size > settings.MAX_PREVIEW_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail="File is too large to preview. Please download it instead."
+            )
+        
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            cache_key = (attachment.id, file_stat.st_mtime_ns)
+            content = _preview_cache.get(cache_key)
+            if content is None:
+                async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
+                    content = await f.read()
+                _preview_cache[cache_key] = content
             
             return {
                 "filename": attachment.file_name,
                 "mime_type": attachment.mime_type,
                 "content": content,
-                "size": file_path.stat().st_size
+                "size": file_stat.st_size
             }
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Cannot read file: {str(e)}")
@@ -393,101 +522,69 @@ async def preview_lesson_attachment(
         path=file_path,
         filename=attachment.file_name,
         media_type=attachment.mime_type,
-        headers={"Content-Disposition": content_disposition}
+        headers={"Content-Disposition": content_disposition},
+        stat_result=file_stat
     )
 
 @router.delete("/{lesson_id}/attachments/{attachment_id}")
 async def delete_lesson_attachment(
     lesson_id: int,
     attachment_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Удалить вложение урока"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
-    
-    # Проверяем права (только автор курса или админ)
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized to delete attachment")
-    
-    attachment = crud_lesson.get_attachment(db, attachment_id=attachment_id)
-    if not attachment or attachment.lesson_id != lesson_id:
+    # Удаляем запись из БД (права проверяются в самом DELETE)
+    deleted = await crud_lesson.delete_owned_attachment(
+        db,
+        attachment_id=attachment_id,
+        lesson_id=lesson_id,
+        user_id=current_user.id,
+        is_admin=current_user.role == UserRole.ADMIN
+    )
+    if not deleted:
+        await _get_authorized_lesson(db, lesson_id, current_user, write=True, detail="Not authorized to delete attachment")
         raise HTTPException(status_code=404, detail="Attachment not found")
     
+    attachment_path, course_id = deleted
+    
     # Удаляем физический файл если он локальный
-    if attachment.file_path and not attachment.file_path.startswith(('http://', 'https://')):
+    if attachment_path and not attachment_path.startswith(_URL_PREFIXES):
         try:
-            file_path = Path(attachment.file_path)
+            file_path = Path(attachment_path)
             if file_path.exists():
                 file_path.unlink()
         except Exception as e:
-            print(f"Error deleting file {attachment.file_path}: {e}")
+            print(f"Error deleting file {attachment_path}: {e}")
     
-    # Удаляем запись из БД
-    crud_lesson.delete_attachment(db, attachment_id=attachment_id)
+    await invalidate_lesson(lesson_id, course_id)
     
     return {"message": "Attachment deleted successfully"}
 
 @router.get("/{lesson_id}/attachments/stats")
 async def get_lesson_attachments_stats(
     lesson_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить статистику по вложениям урока"""
-    lesson = crud_lesson.get_lesson(db, lesson_id=lesson_id)
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lesson not found")
-    
-    # Проверяем доступ к курсу
-    course = crud_course.get_course(db, course_id=lesson.course_id)
-    if not course.is_published and course.author_id != current_user.id and current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    await _get_authorized_lesson(db, lesson_id, current_user, detail="Not authorized")
     
-    attachments = crud_lesson.get_attachments(db, lesson_id=lesson_id)
+    # Статистика считается в БД по сохраненным размерам, без обращения к файлам
+    row = await crud_lesson.get_attachment_stats(db, lesson_id=lesson_id)
     
-    # Собираем статистику
     stats = {
-        "total": len(attachments),
+        "total": row["total"],
         "by_type": {
-            "images": 0,
-            "videos": 0,
-            "documents": 0,
-            "other": 0
+            "images": row["images"],
+            "videos": row["videos"],
+            "documents": row["documents"],
+            "other": row["total"] - row["images"] - row["videos"] - row["documents"]
         },
-        "total_size": 0,
-        "external_links": 0
+        "total_size": row["total_size"],
+        "external_links": row["external_links"]
     }
     
-    for attachment in attachments:
-        # Размер (только для локальных файлов)
-        if attachment.file_path and not attachment.file_path.startswith(('http://', 'https://')):
-            try:
-                file_path = Path(attachment.file_path)
-                if file_path.exists():
-                    stats["total_size"] += file_path.stat().st_size
-            except:
-                pass
-        else:
-            stats["external_links"] += 1
-        
-        # Типы файлов
-        if attachment.is_video:
-            stats["by_type"]["videos"] += 1
-        elif attachment.mime_type and attachment.mime_type.startswith('image/'):
-            stats["by_type"]["images"] += 1
-        elif attachment.mime_type and (
-            attachment.mime_type.startswith('text/') or 
-            attachment.mime_type.startswith('application/') and 
-            not attachment.mime_type.startswith('application/octet-stream')
-        ):
-            stats["by_type"]["documents"] += 1
-        else:
-            stats["by_type"]["other"] += 1
-    
     # Форматируем размер
     def format_size(size_bytes):
         for unit in ['B', 'KB', 'MB', 'GB']:
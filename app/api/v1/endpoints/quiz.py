@@ -1,172 +1,200 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse
+from typing import Union
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
+from app.database import get_db, get_read_db
 from app.schemas.quiz import (
     QuizCreate, QuizCreateResponse,
     QuizUpdate, QuizUpdateResponse,
     QuizDeleteResponse,
-    QuizResponse,
+    QuizResponse, QuizStudentResponse,
     QuizSubmit, QuizResult
 )
 from app.services.quiz_service import QuizService
-from app.api.dependencies import get_current_user
+from app.core.cache import cache_get, cache_set
+from app.api.dependencies import get_current_active_user
 from app.models.user import User
 
 router = APIRouter()
 
+def _student_quiz(quiz_dict: dict) -> dict:
+    """Тест в форме QuizStudentResponse: копия без is_correct, без повторной валидации"""
+    return {
+        **quiz_dict,
+        "questions": [
+            {
+                **question,
+                "answers": [
+                    {"id": answer["id"], "answer_text": answer["answer_text"]}
+                    for answer in question["answers"]
+                ]
+            }
+            for question in quiz_dict["questions"]
+        ]
+    }
+
 # === Создание ===
 @router.post("/lessons/{lesson_id}/quiz", response_model=QuizCreateResponse)
-def create_quiz_for_lesson(
+async def create_quiz_for_lesson(
     lesson_id: int,
     quiz_data: QuizCreate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Создание теста для урока"""
     quiz_service = QuizService(db)
     
-    existing_quiz = quiz_service.get_quiz_by_lesson(lesson_id)
+    existing_quiz = await quiz_service.get_quiz_by_lesson(lesson_id)
     if existing_quiz:
         raise HTTPException(
             status_code=400,
             detail="Quiz already exists for this lesson"
         )
     
-    quiz = quiz_service.create_quiz(lesson_id, quiz_data, current_user.id)
+    quiz = await quiz_service.create_quiz(lesson_id, quiz_data, current_user.id)
     return QuizCreateResponse(message="Quiz created", quiz_id=quiz.id)
 
 # === Получение ===
-@router.get("/quizzes/{quiz_id}", response_model=QuizResponse)
-def get_quiz(
+@router.get("/quizzes/{quiz_id}", response_model=Union[QuizResponse, QuizStudentResponse])
+async def get_quiz(
     quiz_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_read_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Получение теста по ID"""
-    quiz_service = QuizService(db)
-    quiz = quiz_service.get_quiz(quiz_id, include_answers=True)
+    cache_key = f"quiz:{quiz_id}"
+    quiz_dict = await cache_get(cache_key)
+    if quiz_dict is None:
+        quiz_service = QuizService(db)
+        quiz = await quiz_service.get_quiz(quiz_id, include_answers=True)
+    
+        if not quiz:
+            raise HTTPException(status_code=404, detail="Quiz not found")
     
-    if not quiz:
-        raise HTTPException(status_code=404, detail="Quiz not found")
+        # В кэше хранится полная версия теста, студентам отдается схема без правильных ответов
+        quiz_dict = QuizResponse.model_validate(quiz).model_dump()
+        await cache_set(cache_key, quiz_dict)
     
     # Для студентов скрываем правильные ответы
-    if quiz.author_id != current_user.id and not current_user.is_admin:
-        for question in quiz.questions:
-            for answer in question.answers:
-                answer.is_correct = None
+    if quiz_dict["author_id"] != current_user.id and not current_user.is_admin:
+        quiz_dict = _student_quiz(quiz_dict)
     
-    return quiz
+    # Словарь уже соответствует схеме: отдаем его напрямую, минуя повторную валидацию response_model
+    return ORJSONResponse(quiz_dict)
 
-@router.get("/lessons/{lesson_id}/quiz", response_model=QuizResponse)
-def get_lesson_quiz(
+@router.get("/lessons/{lesson_id}/quiz", response_model=Union[QuizResponse, QuizStudentResponse])
+async def get_lesson_quiz(
     lesson_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_read_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Получение теста для урока"""
-    quiz_service = QuizService(db)
-    quiz = quiz_service.get_quiz_by_lesson(lesson_id)
+    cache_key = f"lesson:{lesson_id}:quiz"
+    quiz_dict = await cache_get(cache_key)
+    if quiz_dict is None:
+        quiz_service = QuizService(db)
+        quiz = await quiz_service.get_quiz_by_lesson(lesson_id, include_answers=True)
+    
+        if not quiz:
+            raise HTTPException(status_code=404, detail="Quiz not found for this lesson")
     
-    if not quiz:
-        raise HTTPException(status_code=404, detail="Quiz not found for this lesson")
+        quiz_dict = QuizResponse.model_validate(quiz).model_dump()
+        await cache_set(cache_key, quiz_dict)
     
     # Для студентов скрываем правильные ответы
-    quiz_with_answers = quiz_service.get_quiz(quiz.id, include_answers=True)
-    if quiz_with_answers.author_id != current_user.id:
-        for question in quiz_with_answers.questions:
-            for answer in question.answers:
-                answer.is_correct = None
+    if quiz_dict["author_id"] != current_user.id and not current_user.is_admin:
+        quiz_dict = _student_quiz(quiz_dict)
     
-    return quiz_with_answers
+    return ORJSONResponse(quiz_dict)
 
 # === Обновление (ПОЛНОЕ - заменяет все вопросы) ===
 @router.put("/quizzes/{quiz_id}", response_model=QuizUpdateResponse)
-def update_quiz(
+async def update_quiz(
     quiz_id: int,
     update_data: QuizUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Полное обновление теста - заменяет ВСЕ вопросы и ответы"""
     quiz_service = QuizService(db)
     
-    quiz = quiz_service.update_quiz(quiz_id, update_data, current_user.id)
+    quiz = await quiz_service.update_quiz(quiz_id, update_data, current_user.id, current_user.is_admin)
     return QuizUpdateResponse(message="Quiz updated", quiz_id=quiz.id)
 
 # === Частичное обновление ===
 @router.patch("/quizzes/{quiz_id}", response_model=QuizUpdateResponse)
-def update_quiz_partial(
+async def update_quiz_partial(
     quiz_id: int,
     update_data: QuizUpdate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Частичное обновление теста (только измененные поля)"""
     quiz_service = QuizService(db)
     
-    quiz = quiz_service.update_quiz_partial(quiz_id, update_data, current_user.id)
+    quiz = await quiz_service.update_quiz_partial(quiz_id, update_data, current_user.id, current_user.is_admin)
     return QuizUpdateResponse(message="Quiz updated", quiz_id=quiz.id)
 
 # === Удаление теста ===
 @router.delete("/quizzes/{quiz_id}", response_model=QuizDeleteResponse)
-def delete_quiz(
+async def delete_quiz(
     quiz_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Удаление теста (удалит все вопросы и ответы каскадно)"""
     quiz_service = QuizService(db)
     
-    quiz_service.delete_quiz(quiz_id, current_user.id)
+    await quiz_service.delete_quiz(quiz_id, current_user.id, current_user.is_admin)
     return QuizDeleteResponse(message="Quiz deleted")
 
 # === Удаление вопроса ===
 @router.delete("/questions/{question_id}", response_model=QuizDeleteResponse)
-def delete_question(
+async def delete_question(
     question_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Удаление вопроса (удалит все ответы каскадно)"""
     quiz_service = QuizService(db)
     
-    quiz_service.delete_question(question_id, current_user.id)
+    await quiz_service.delete_question(question_id, current_user.id, current_user.is_admin)
     return QuizDeleteResponse(message="Question deleted")
 
 # === Удаление ответа ===
 @router.delete("/answers/{answer_id}", response_model=QuizDeleteResponse)
-def delete_answer(
+async def delete_answer(
     answer_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Удаление конкретного ответа"""
     quiz_service = QuizService(db)
     
-    quiz_service.delete_answer(answer_id, current_user.id)
+    await quiz_service.delete_answer(answer_id, current_user.id, current_user.is_admin)
     return QuizDeleteResponse(message="Answer deleted")
 
 # === Проверка ответов ===
 @router.post("/quizzes/{quiz_id}/submit", response_model=QuizResult)
-def submit_quiz_answers(
+async def submit_quiz_answers(
     quiz_id: int,
     submit_data: QuizSubmit,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Отправка ответов на тест"""
     quiz_service = QuizService(db)
-    result = quiz_service.submit_quiz(quiz_id, submit_data, current_user.id)
+    result = await quiz_service.submit_quiz(quiz_id, submit_data, current_user.id)
     return result
 
 @router.get("/quizzes/{quiz_id}/result")
-def get_quiz_result(
+async def get_quiz_result(
     quiz_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_read_db),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Получение результата теста пользователя"""
     quiz_service = QuizService(db)
-    result = quiz_service.get_user_result(quiz_id, current_user.id)
+    result = await quiz_service.get_user_result(quiz_id, current_user.id)
     return result
\ No newline at end of file
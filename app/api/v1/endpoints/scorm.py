@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, BackgroundTasks
-from sqlalchemy.orm import Session
-from typing import List
-import tempfile
-import shutil
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import asyncio
+import multiprocessing
 from pathlib import Path
 from app.database import get_db
 from app.api.dependencies import get_current_active_user, require_role
@@ -12,24 +14,57 @@ from app.crud import lesson as crud_lesson
 from app.services.scorm_parser import SCORMParser
 from app.schemas.lesson import LessonCreate, LessonAttachmentCreate
 from app.config import settings
+from app.core.cache import invalidate_course
 import os
 import logging
 
 router = APIRouter()
-scorm_parser = SCORMParser()
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=1)
+def get_scorm_parser() -> SCORMParser:
+    # Парсер (и его каталог) создается при первом импорте SCORM пакета, а не при старте процесса
+    return SCORMParser()
+
+# Конвертация HTML в Markdown нагружает CPU, поэтому выполняется в пуле процессов (создается лениво)
+_convert_executor: Optional[ProcessPoolExecutor] = None
+
+def _get_convert_executor() -> ProcessPoolExecutor:
+    global _convert_executor
+    if _convert_executor is None:
+        # forkserver вместо fork: рабочие процессы не наследуют потоки сервера (aiosqlite, anyio)
+        # и захваченные ими блокировки, например блокировку обработчика логов
+        _convert_executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver"))
+    return _convert_executor
+
+# Число HTML файлов, конвертируемых одной задачей пула
+_CONVERT_BATCH_SIZE = 4
+
+# Допустимые расширения SCORM пакета
+_SCORM_PACKAGE_EXTENSIONS = frozenset({'.zip', '.scorm', '.pif'})
+
+# MIME-типы изображений SCORM по расширению
+_IMAGE_MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.svg': 'image/svg+xml',
+    '.webp': 'image/webp'
+}
+
 @router.post("/import/{course_id}")
 async def import_scorm_package(
     course_id: int,
     file: UploadFile = File(...),
     background_tasks: BackgroundTasks = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_role(UserRole.AUTHOR))
 ):
     """Импортировать SCORM пакет в курс с сохранением изображений"""
     # Проверяем курс
-    course = crud_course.get_course(db, course_id=course_id)
+    course = await crud_course.get_course(db, course_id=course_id)
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
@@ -41,32 +76,34 @@ async def import_scorm_package(
     if not file.filename:
         raise HTTPException(status_code=400, detail="Filename is required")
     
-    file_ext = Path(file.filename).suffix.lower()
-    if file_ext not in ['.zip', '.scorm', '.pif']:
+    file_ext = os.path.splitext(file.filename)[1].lower()
+    if file_ext not in _SCORM_PACKAGE_EXTENSIONS:
         raise HTTPException(
             status_code=400, 
             detail="File must be a ZIP or SCORM package (.zip, .scorm, .pif)"
         )
     
-    # Сохраняем временный файл
-    temp_dir = tempfile.mkdtemp(prefix="scorm_import_")
-    temp_file_path = Path(temp_dir) / (file.filename or "scorm_package.zip")
+    # Starlette уже сохранил загрузку в SpooledTemporaryFile, ZIP читается прямо из него без копии на диск
+    file_size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(0)
+    if file_size > settings.MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Файл больше {settings.MAX_UPLOAD_SIZE} байт"
+        )
     
+    extract_dir = None
+    lessons = []
+    cleanup_scheduled = False
     try:
         logger.info(f"Начало импорта SCORM пакета для курса {course_id}")
-        
-        # Сохраняем загруженный файл
-        with open(temp_file_path, 'wb') as f:
-            content = await file.read()
-            f.write(content)
-        
-        logger.info(f"Файл сохранен: {temp_file_path}, размер: {temp_file_path.stat().st_size} байт")
+        logger.info(f"Размер пакета: {file_size} байт")
         
         # Извлекаем и парсим SCORM пакет
-        extract_dir = Path(scorm_parser.upload_dir) / f"course_{course_id}_{os.urandom(4).hex()}"
+        extract_dir = Path(get_scorm_parser().upload_dir) / f"course_{course_id}_{os.urandom(4).hex()}"
         logger.info(f"Извлечение в: {extract_dir}")
         
-        metadata = scorm_parser.extract_scorm_package(temp_file_path, extract_dir)
+        metadata = get_scorm_parser().extract_scorm_package(file.file, extract_dir)
         extracted_path = metadata['extracted_path']
         
         # Создаем уроки из SCORM контента
@@ -76,112 +113,117 @@ async def import_scorm_package(
         logger.info(f"Найдено HTML файлов: {len(metadata.get('html_files', []))}")
         logger.info(f"Найдено изображений: {len(metadata.get('image_files', []))}")
         
-        for i, html_file in enumerate(metadata.get('html_files', [])):
-            try:
-                logger.info(f"Обработка файла {i+1}: {html_file}")
-                
-                # Сначала создаем урок с временным заголовком
-                file_name = Path(html_file).stem
-                temp_title = f"{file_name}"
-                if len(metadata.get('html_files', [])) > 1:
-                    temp_title = f"Урок {i+1}: {temp_title}"
-                
-                lesson_data = LessonCreate(
-                    title=temp_title,
-                    content="Конвертация...",
-                    course_id=course_id,
-                    order=i
-                )
-                
-                lesson = crud_lesson.create_lesson(db, lesson_data)
-                lesson_id = lesson.id
-                
-                # Конвертируем HTML в Markdown с обработкой изображений
-                markdown_content, images_info = scorm_parser.convert_to_markdown_with_images(
-                    html_file,
-                    extracted_path,
-                    settings.UPLOAD_DIR,
-                    course_id,
-                    lesson_id
-                )
-                
-                # Обновляем урок с конвертированным контентом
-                lesson.title = temp_title  # Можно улучшить, извлекая заголовок из HTML
-                lesson.content = markdown_content
-                
-                # Сохраняем SCORM метаданные
-                lesson.scorm_data = {
+        html_files = metadata.get('html_files', [])
+        
+        # Сначала создаем все уроки с временными заголовками одним INSERT
+        lessons_data = []
+        for i, html_file in enumerate(html_files):
+            file_name = Path(html_file).stem
+            temp_title = f"{file_name}"
+            if len(html_files) > 1:
+                temp_title = f"Урок {i+1}: {temp_title}"
+            
+            lessons_data.append(LessonCreate(
+                title=temp_title,
+                content="Конвертация...",
+                course_id=course_id,
+                order=i
+            ))
+        
+        lessons = await crud_lesson.create_lessons(db, lessons_data)
+        
+        # Конвертируем HTML в Markdown с обработкой изображений параллельно в пуле процессов.
+        # Файлы отправляются пачками: меньше передач между процессами на пакетах из сотен уроков
+        loop = asyncio.get_running_loop()
+        executor = _get_convert_executor()
+        items = [(html_file, lesson.id) for html_file, lesson in zip(html_files, lessons)]
+        batches = await asyncio.gather(*(
+            loop.run_in_executor(
+                executor,
+                get_scorm_parser().convert_lessons,
+                items[start:start + _CONVERT_BATCH_SIZE],
+                extracted_path,
+                settings.UPLOAD_DIR,
+                course_id
+            )
+            for start in range(0, len(items), _CONVERT_BATCH_SIZE)
+        ), return_exceptions=True)
+        
+        # Упавшая целиком пачка (например, процесс пула завершился) - ошибка для каждого ее файла
+        results = []
+        for start, batch in zip(range(0, len(items), _CONVERT_BATCH_SIZE), batches):
+            if isinstance(batch, Exception):
+                batch = [batch] * len(items[start:start + _CONVERT_BATCH_SIZE])
+            results.extend(batch)
+        
+        lesson_updates = []
+        attachments_data = []
+        failed_lesson_ids = []
+        for html_file, lesson, result in zip(html_files, lessons, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка при создании урока из файла {html_file}: {str(result)}")
+                failed_conversions.append({
+                    'file': html_file,
+                    'error': str(result)
+                })
+                failed_lesson_ids.append(lesson.id)
+                continue
+            
+            markdown_content, images_info = result
+            
+            # Обновляем урок с конвертированным контентом и SCORM метаданными
+            lesson_updates.append({
+                "id": lesson.id,
+                "content": markdown_content,
+                "scorm_data": {
                     "source_file": html_file,
                     "scorm_metadata": {
                         'title': metadata.get('title'),
                         'description': metadata.get('description'),
                         'encoding_used': metadata.get('encoding_used')
                     },
-                    "original_file_name": file_name,
+                    "original_file_name": Path(html_file).stem,
                     "imported_from_scorm": True,
                     "images_count": len(images_info)
                 }
+            })
+            
+            # Создаем записи для прикрепленных изображений
+            for img_info in images_info:
+                # Определяем MIME-тип по расширению
+                ext = os.path.splitext(img_info['filename'])[1].lower()
+                mime_type = _IMAGE_MIME_TYPES.get(ext, 'application/octet-stream')
                 
-                # Создаем записи для прикрепленных изображений
-# В функции import_scorm_package, после обработки изображений добавьте:
-                for img_info in images_info:
-                    # Определяем MIME-тип по расширению
-                    ext = Path(img_info['filename']).suffix.lower()
-                    mime_types = {
-                        '.jpg': 'image/jpeg',
-                        '.jpeg': 'image/jpeg',
-                        '.png': 'image/png',
-                        '.gif': 'image/gif',
-                        '.bmp': 'image/bmp',
-                        '.svg': 'image/svg+xml',
-                        '.webp': 'image/webp'
-                    }
-                    mime_type = mime_types.get(ext, 'application/octet-stream')
-                    
-                    # Проверяем размер файла
-                    file_size = Path(img_info['new_path']).stat().st_size
-                    
-                    # Создаем запись вложения
-                    attachment_data = LessonAttachmentCreate(
-                        lesson_id=lesson_id,
-                        file_name=img_info['filename'],
-                        file_path=img_info['new_path'],
-                        file_size=file_size,
-                        mime_type=mime_type,
-                        is_video=False
-                    )
-                    
-                    # Создаем вложение в базе данных
-                    crud_lesson.create_attachment(db, attachment_data)
-                    logger.info(f"Создано вложение: {img_info['filename']}")
-
-                db.commit()
-                db.refresh(lesson)
-                
-                lessons_created.append({
-                    'id': lesson.id,
-                    'title': lesson.title,
-                    'file': html_file,
-                    'content_length': len(markdown_content),
-                    'images_count': len(images_info)
-                })
-                
-                logger.info(f"Создан урок {lesson.id}: {lesson.title}, изображений: {len(images_info)}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка при создании урока из файла {html_file}: {str(e)}")
-                failed_conversions.append({
-                    'file': html_file,
-                    'error': str(e)
-                })
-                continue
+                attachments_data.append(LessonAttachmentCreate(
+                    lesson_id=lesson.id,
+                    file_name=img_info['filename'],
+                    file_path=img_info['new_path'],
+                    file_size=img_info['size'],
+                    mime_type=mime_type,
+                    is_video=False
+                ))
+            
+            lessons_created.append({
+                'id': lesson.id,
+                'title': lesson.title,
+                'file': html_file,
+                'content_length': len(markdown_content),
+                'images_count': len(images_info)
+            })
+            
+            logger.info(f"Создан урок {lesson.id}: {lesson.title}, изображений: {len(images_info)}")
         
-        # Удаляем временный файл
-        shutil.rmtree(temp_dir)
+        # Уроки обновляются одним UPDATE, вложения всех уроков создаются одним INSERT, все - одним коммитом.
+        # Вставка уроков коммитится раньше, чтобы не держать блокировку записи во время конвертации
+        # Уроки-заготовки для файлов, которые не удалось конвертировать, удаляются в той же транзакции
+        await crud_lesson.update_lessons(db, lesson_updates, commit=False)
+        await crud_lesson.create_attachments(db, attachments_data, commit=False)
+        await crud_lesson.delete_lessons(db, failed_lesson_ids, commit=False)
+        await db.commit()
+        logger.debug("Создано вложений: %d", len(attachments_data))
         
-        # Очищаем извлеченные файлы через background task
-        if background_tasks:
-            background_tasks.add_task(scorm_parser.cleanup_extracted_files, extracted_path)
+        if lessons_created:
+            await invalidate_course(course_id)
         
         response = {
             "message": f"SCORM пакет успешно обработан",
@@ -206,19 +248,30 @@ async def import_scorm_package(
             response["warning"] = f"Не удалось конвертировать {len(failed_conversions)} файлов"
         
         logger.info(f"Импорт завершен: создано {len(lessons_created)} уроков")
+        
+        # Очищаем извлеченные файлы через background task
+        if background_tasks:
+            background_tasks.add_task(get_scorm_parser().cleanup_extracted_files, extract_dir)
+            cleanup_scheduled = True
         return response
         
     except Exception as e:
         logger.error(f"Ошибка импорта SCORM пакета: {str(e)}")
         
-        # Очищаем в случае ошибки
-        if Path(temp_dir).exists():
+        # Незавершенный импорт не оставляет в курсе уроков-заготовок "Конвертация..."
+        if lessons:
             try:
-                shutil.rmtree(temp_dir)
-            except:
-                pass
+                await db.rollback()
+                await crud_lesson.delete_lessons(db, [lesson.id for lesson in lessons])
+                await invalidate_course(course_id)
+            except Exception as cleanup_error:
+                logger.error(f"Не удалось удалить уроки незавершенного импорта: {cleanup_error}")
         
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Не удалось импортировать SCORM пакет: {str(e)}"
-        )
\ No newline at end of file
+        )
+    finally:
+        # При ошибке извлеченный пакет удаляется сразу, иначе он остался бы в uploads/scorm
+        if extract_dir is not None and not cleanup_scheduled:
+            await asyncio.to_thread(get_scorm_parser().cleanup_extracted_files, extract_dir)
\ No newline at end of file
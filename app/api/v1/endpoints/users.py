@@ -1,29 +1,36 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
 from app.database import get_db
 from app.schemas.user import UserResponse, UserUpdate
 from app.crud import user as crud_user
 from app.api.dependencies import get_current_active_user, require_role
 from app.models.user import User, UserRole
+from app.core.cache import cache_delete
 
 router = APIRouter()
 
 @router.get("/", response_model=List[UserResponse])
 async def read_users(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
-    """Получить список пользователей (только для администраторов)"""
-    users = db.query(User).offset(skip).limit(limit).all()
+    """Получить список пользователей (только для администраторов).
+    Для больших списков передавайте after_id из заголовка X-Next-Cursor вместо skip"""
+    users = await crud_user.get_users(db, skip=skip, limit=limit, after_id=after_id)
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = str(users[-1].id)
     return users
 
 @router.get("/{user_id}", response_model=UserResponse)
 async def read_user(
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Получить пользователя по ID"""
@@ -34,7 +41,7 @@ async def read_user(
             detail="Not authorized to view this user"
         )
     
-    user = crud_user.get_user(db, user_id=user_id)
+    user = await crud_user.get_user(db, user_id=user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -44,7 +51,7 @@ async def read_user(
 async def update_user(
     user_id: int,
     user_update: UserUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
     """Обновить пользователя"""
@@ -55,7 +62,7 @@ async def update_user(
             detail="Not authorized to update this user"
         )
     
-    updated_user = crud_user.update_user(db, user_id=user_id, user_update=user_update)
+    updated_user = await crud_user.update_user(db, user_id=user_id, user_update=user_update)
     if not updated_user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -64,7 +71,7 @@ async def update_user(
 @router.delete("/{user_id}")
 async def delete_user(
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
     """Удалить пользователя (только для администраторов)"""
@@ -75,8 +82,17 @@ async def delete_user(
             detail="Cannot delete yourself"
         )
     
-    user = crud_user.delete_user(db, user_id=user_id)
+    try:
+        user = await crud_user.delete_user(db, user_id=user_id)
+    except IntegrityError:
+        # На пользователя ссылаются его курсы или записи на курсы
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="User still has courses or enrollments"
+        )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    # Созданные пользователем тесты остались без автора, их закэшированные копии устарели
+    await cache_delete(f"user:{user_id}:*", "quiz:*", "lesson:*:quiz")
     return {"message": "User deleted successfully"}
\ No newline at end of file
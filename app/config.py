@@ -5,9 +5,21 @@ class Settings(BaseSettings):
     APP_NAME: str = "LMS Platform"
     APP_VERSION: str = "1.0.0"
     DEBUG: bool = True
+    WORKERS: int = 1  # В продакшене обычно 2 * число ядер + 1
     
     # Настройки базы данных
     DATABASE_URL: str = "sqlite:///./lms.db"
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 40
+    DB_POOL_TIMEOUT: int = 10  # Секунд ожидания свободного соединения
+    DB_POOL_RECYCLE: int = 1800  # Пересоздавать соединения старше 30 минут
+    DB_READ_POOL_SIZE: int = 8  # Соединения только для чтения (SQLite в режиме WAL)
+    # Создание таблиц, обновление схемы и каталогов загрузок при старте процесса;
+    # в продакшене отключается, если это делает отдельный шаг деплоя
+    RUN_MIGRATIONS: bool = True
+    # Потоки для синхронного кода (хэширование паролей, рендер Markdown);
+    # должно быть не больше DB_POOL_SIZE + DB_MAX_OVERFLOW, иначе потоки ждут соединений из пула
+    THREADPOOL_SIZE: int = 20
     
     # Настройки безопасности
     SECRET_KEY: str = "your-secret-key-change-in-production"
@@ -17,6 +29,16 @@ class Settings(BaseSettings):
     # Настройки загрузки файлов
     MAX_UPLOAD_SIZE: int = 50 * 1024 * 1024  # 50MB
     UPLOAD_DIR: str = "./uploads"
+    MAX_PREVIEW_SIZE: int = 1024 * 1024  # 1MB, текстовые файлы больше не отображаются в превью
+    PREVIEW_CACHE_SIZE: int = 16 * 1024 * 1024  # Суммарный размер кэша превью в символах
+    # Префикс internal-location nginx для X-Accel-Redirect (пустой - файлы отдает приложение)
+    X_ACCEL_REDIRECT_PREFIX: str = ""
+    # Базовый URL CDN, зеркалирующего /uploads (пустой - файлы отдает приложение)
+    MEDIA_BASE_URL: str = ""
+    
+    # Настройки кэша (пустой REDIS_URL отключает кэширование)
+    REDIS_URL: str = ""
+    CACHE_EXPIRE_SECONDS: int = 300
     
     # Настройки CORS
     ALLOWED_ORIGINS: list = ["http://localhost:3000", "http://localhost:5173"]
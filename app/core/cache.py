@@ -0,0 +1,88 @@
+import asyncio
+import json
+import logging
+from typing import Any, List, Optional
+from fastapi.encoders import jsonable_encoder
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Клиент создается лениво; без REDIS_URL кэш отключен
+_redis: Optional[aioredis.Redis] = None
+
+def get_redis() -> Optional[aioredis.Redis]:
+    global _redis
+    if not settings.REDIS_URL:
+        return None
+    if _redis is None:
+        _redis = aioredis.from_url(
+            settings.REDIS_URL,
+            decode_responses=True,
+            socket_connect_timeout=1,
+            socket_timeout=1
+        )
+    return _redis
+
+async def cache_get(key: str) -> Optional[Any]:
+    """Возвращает закэшированное значение или None"""
+    redis = get_redis()
+    if redis is None:
+        return None
+    try:
+        value = await redis.get(key)
+    except RedisError as e:
+        logger.warning(f"Кэш недоступен, чтение {key} пропущено: {e}")
+        return None
+    return json.loads(value) if value is not None else None
+
+async def cache_set(key: str, value: Any, expire: Optional[int] = None) -> None:
+    """Сохраняет значение в кэш в виде JSON"""
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.set(
+            key,
+            json.dumps(jsonable_encoder(value)),
+            ex=expire or settings.CACHE_EXPIRE_SECONDS
+        )
+    except RedisError as e:
+        logger.warning(f"Кэш недоступен, запись {key} пропущена: {e}")
+
+async def cache_delete(*patterns: str) -> None:
+    """Удаляет ключи по шаблонам (glob-стиль Redis)"""
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        for pattern in patterns:
+            keys = [key async for key in redis.scan_iter(match=pattern)]
+            if keys:
+                await redis.delete(*keys)
+    except RedisError as e:
+        logger.warning(f"Кэш недоступен, инвалидация {patterns} пропущена: {e}")
+
+async def invalidate_course(course_id: int) -> None:
+    """Сбрасывает кэш курса, его уроков и списков курсов"""
+    await cache_delete("courses:*", f"course:{course_id}", f"course:{course_id}:*")
+
+async def invalidate_lesson(lesson_id: int, course_id: int) -> None:
+    """Сбрасывает кэш урока и зависящих от него данных курса"""
+    await asyncio.gather(
+        cache_delete(f"lesson:{lesson_id}", f"lesson:{lesson_id}:*"),
+        invalidate_course(course_id)
+    )
+
+async def invalidate_lessons(lesson_ids: List[int]) -> None:
+    """Сбрасывает кэш уроков (например, удаленных вместе с курсом)"""
+    patterns = []
+    for lesson_id in lesson_ids:
+        patterns += [f"lesson:{lesson_id}", f"lesson:{lesson_id}:*"]
+    if patterns:
+        await cache_delete(*patterns)
+
+async def invalidate_quiz(quiz_id: int, lesson_id: Optional[int]) -> None:
+    """Сбрасывает кэш теста (по ID и по уроку)"""
+    await cache_delete(f"quiz:{quiz_id}", f"lesson:{lesson_id}:quiz")
\ No newline at end of file
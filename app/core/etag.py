@@ -0,0 +1,23 @@
+import hashlib
+import json
+from typing import Any
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+def compute_etag(payload: Any) -> str:
+    """Строгий ETag по содержимому ответа"""
+    raw = json.dumps(jsonable_encoder(payload), sort_keys=True, ensure_ascii=False)
+    return f'"{hashlib.sha1(raw.encode()).hexdigest()}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Проверяет заголовок If-None-Match"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
\ No newline at end of file
@@ -0,0 +1,30 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Число SQL-запросов, выполненных при обработке текущего HTTP-запроса
+QUERY_COUNT_WARN_THRESHOLD = 10
+
+_query_counter: ContextVar[Optional[List[int]]] = ContextVar("query_counter", default=None)
+
+def count_queries(engine) -> None:
+    """Подключает к движку подсчет запросов (для отладки N+1)"""
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        counter = _query_counter.get()
+        if counter is not None:
+            counter[0] += 1
+
+@contextmanager
+def track_queries() -> Iterator[List[int]]:
+    """Считает запросы внутри блока; счетчик - список из одного числа"""
+    counter = [0]
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
\ No newline at end of file
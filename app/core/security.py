@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from typing import Optional
+import anyio
 import jwt
 from passlib.context import CryptContext
 from app.config import settings
@@ -14,6 +15,13 @@ def get_password_hash(password: str):
     """Хеширует пароль"""
     return pwd_context.hash(password)
 
+# Хеширование нагружает CPU, поэтому в async-коде выполняется в пуле потоков
+async def verify_password_async(plain_password, hashed_password):
+    return await anyio.to_thread.run_sync(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str):
+    return await anyio.to_thread.run_sync(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -11,6 +11,8 @@ from .user import (
 from .course import (
     get_course,
     get_courses,
+    get_course_list_rows,
+    get_enrolled_course_rows,
     create_course,
     update_course,
     delete_course,
@@ -27,5 +29,6 @@ from .lesson import (
     delete_lesson,
     create_attachment,
     get_attachments,
+    get_attachment_rows,
     delete_attachment
 )
\ No newline at end of file
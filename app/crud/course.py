@@ -1,37 +1,103 @@
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload, with_expression
+from sqlalchemy.orm.attributes import set_committed_value
 from app.models.course import Course, CourseEnrollment
+from app.models.lesson import Lesson
+from app.models.user import User
 from app.schemas.course import CourseCreate, CourseUpdate
 from typing import List, Optional
 
-def get_course(db: Session, course_id: int):
-    return db.query(Course).filter(Course.id == course_id).first()
+def _lesson_count_expr():
+    return select(func.count(Lesson.id)).where(Lesson.course_id == Course.id).scalar_subquery()
 
-def get_courses(
-    db: Session, 
-    skip: int = 0, 
+def _course_details_options():
+    # Автор и количество уроков загружаются вместе с курсом, без N+1
+    return (joinedload(Course.author), with_expression(Course.lesson_count, _lesson_count_expr()))
+
+async def get_course(db: AsyncSession, course_id: int):
+    result = await db.execute(select(Course).where(Course.id == course_id))
+    return result.scalars().first()
+
+async def get_course_with_details(db: AsyncSession, course_id: int):
+    result = await db.execute(
+        select(Course).options(*_course_details_options()).where(Course.id == course_id)
+    )
+    return result.scalars().first()
+
+async def get_courses(
+    db: AsyncSession,
+    skip: int = 0,
     limit: int = 100,
     author_id: Optional[int] = None,
     published_only: bool = True
 ):
-    query = db.query(Course)
+    query = select(Course).options(*_course_details_options())
     
     if author_id:
-        query = query.filter(Course.author_id == author_id)
+        query = query.where(Course.author_id == author_id)
     
     if published_only:
-        query = query.filter(Course.is_published == True)
+        query = query.where(Course.is_published == True)
     
-    return query.offset(skip).limit(limit).all()
+    result = await db.execute(query.offset(skip).limit(limit))
+    return result.scalars().all()
+
+def _course_list_query():
+    # Плоская выборка для списков: без гидрации ORM-объектов
+    return select(
+        Course.id,
+        Course.title,
+        Course.description,
+        Course.short_description,
+        Course.thumbnail_url,
+        Course.is_published,
+        Course.is_free,
+        Course.price,
+        Course.author_id,
+        Course.created_at,
+        Course.updated_at,
+        User.full_name.label("author_name"),
+        _lesson_count_expr().label("lesson_count")
+    ).join(User, Course.author_id == User.id)
+
+async def get_course_list_rows(
+    db: AsyncSession,
+    skip: int = 0,
+    limit: int = 100,
+    author_id: Optional[int] = None,
+    published_only: bool = True
+):
+    """Получить курсы для списка в виде словарей (с автором и количеством уроков)"""
+    query = _course_list_query()
+    
+    if author_id:
+        query = query.where(Course.author_id == author_id)
+    
+    if published_only:
+        query = query.where(Course.is_published == True)
+    
+    result = await db.execute(query.offset(skip).limit(limit))
+    return result.mappings().all()
+
+async def get_enrolled_course_rows(db: AsyncSession, user_id: int):
+    """Получить курсы, на которые записан пользователь, в виде словарей"""
+    result = await db.execute(_course_list_query().join(
+        CourseEnrollment, CourseEnrollment.course_id == Course.id
+    ).where(CourseEnrollment.student_id == user_id))
+    return result.mappings().all()
 
-def create_course(db: Session, course: CourseCreate, author_id: int):
+async def create_course(db: AsyncSession, course: CourseCreate, author_id: int):
     db_course = Course(**course.dict(), author_id=author_id)
     db.add(db_course)
-    db.commit()
-    db.refresh(db_course)
+    await db.commit()
+    await db.refresh(db_course)
     return db_course
 
-def update_course(db: Session, course_id: int, course_update: CourseUpdate):
-    db_course = get_course(db, course_id)
+async def update_course(db: AsyncSession, course_id: int, course_update: CourseUpdate):
+    db_course = await get_course(db, course_id)
     if not db_course:
         return None
     
@@ -40,34 +106,102 @@ def update_course(db: Session, course_id: int, course_update: CourseUpdate):
     for field, value in update_data.items():
         setattr(db_course, field, value)
     
-    db.commit()
-    db.refresh(db_course)
+    await db.commit()
+    await db.refresh(db_course)
     return db_course
 
-def delete_course(db: Session, course_id: int):
-    db_course = get_course(db, course_id)
+async def get_owned_course(db: AsyncSession, course_id: int, user_id: int, is_admin: bool = False):
+    """Получить курс, если пользователь его автор (админ видит любой курс)"""
+    query = select(Course).where(Course.id == course_id)
+    if not is_admin:
+        query = query.where(Course.author_id == user_id)
+    
+    result = await db.execute(query)
+    return result.scalars().first()
+
+async def update_owned_course(
+    db: AsyncSession,
+    course_id: int,
+    course_update: CourseUpdate,
+    user_id: int,
+    is_admin: bool = False
+):
+    """Обновить курс одним UPDATE с проверкой автора; None, если курса нет или он чужой"""
+    update_data = course_update.dict(exclude_unset=True)
+    if not update_data:
+        return await get_owned_course(db, course_id, user_id, is_admin)
+    
+    stmt = update(Course).where(Course.id == course_id)
+    if not is_admin:
+        stmt = stmt.where(Course.author_id == user_id)
+    
+    # with_expression не работает с RETURNING, поэтому количество уроков выбирается отдельной колонкой
+    result = await db.execute(
+        stmt.values(**update_data).returning(Course, _lesson_count_expr())
+    )
+    row = result.first()
+    db_course = None
+    if row:
+        db_course, lesson_count = row
+        set_committed_value(db_course, "lesson_count", lesson_count)
+    await db.commit()
+    return db_course
+
+async def delete_owned_course(db: AsyncSession, course_id: int, user_id: int, is_admin: bool = False):
+    # Удаление через ORM, чтобы сработали каскады уроков и записей на курс
+    db_course = await get_owned_course(db, course_id, user_id, is_admin)
+    if db_course:
+        await db.delete(db_course)
+        await db.commit()
+    return db_course
+
+async def delete_course(db: AsyncSession, course_id: int):
+    db_course = await get_course(db, course_id)
     if db_course:
-        db.delete(db_course)
-        db.commit()
+        await db.delete(db_course)
+        await db.commit()
     return db_course
 
-def enroll_student(db: Session, course_id: int, student_id: int):
-    # Проверяем, не записан ли уже студент
-    existing = db.query(CourseEnrollment).filter(
+_UPSERT_INSERTS = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}
+
+async def get_enrollment(db: AsyncSession, course_id: int, student_id: int):
+    result = await db.execute(select(CourseEnrollment).where(
         CourseEnrollment.course_id == course_id,
         CourseEnrollment.student_id == student_id
-    ).first()
+    ))
+    return result.scalars().first()
+    
+async def enroll_student(db: AsyncSession, course_id: int, student_id: int):
+    dialect_insert = _UPSERT_INSERTS.get(db.bind.dialect.name)
+    if dialect_insert is None:
+        # Диалект без ON CONFLICT: проверяем, не записан ли уже студент
+        existing = await get_enrollment(db, course_id, student_id)
+        if existing:
+            return existing
     
-    if existing:
-        return existing
+        enrollment = CourseEnrollment(course_id=course_id, student_id=student_id)
+        db.add(enrollment)
+        await db.commit()
+        await db.refresh(enrollment)
+        return enrollment
+
+    # Атомарная запись: параллельные запросы не создадут дубликат и не упадут на уникальном индексе
+    result = await db.scalars(
+        dialect_insert(CourseEnrollment)
+        .values(course_id=course_id, student_id=student_id)
+        .on_conflict_do_nothing(index_elements=["course_id", "student_id"])
+        .returning(CourseEnrollment)
+    )
+    enrollment = result.first()
+    await db.commit()
     
-    enrollment = CourseEnrollment(course_id=course_id, student_id=student_id)
-    db.add(enrollment)
-    db.commit()
-    db.refresh(enrollment)
+    if enrollment is None:
+        # Студент уже записан
+        enrollment = await get_enrollment(db, course_id, student_id)
     return enrollment
 
-def get_user_enrollments(db: Session, user_id: int):
-    return db.query(CourseEnrollment).filter(
+async def get_user_enrollments(db: AsyncSession, user_id: int):
+    result = await db.execute(select(CourseEnrollment).where(
         CourseEnrollment.student_id == user_id
-    ).options(joinedload(CourseEnrollment.course)).all()
\ No newline at end of file
+    ).options(selectinload(CourseEnrollment.course).options(*_course_details_options())))
+    return result.scalars().all()
\ No newline at end of file
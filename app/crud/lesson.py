@@ -1,30 +1,100 @@
-from sqlalchemy.orm import Session, joinedload
-from app.models.lesson import Lesson, LessonAttachment
+from sqlalchemy import select, insert, update, delete, func, or_, and_, not_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload, with_expression
+from sqlalchemy.orm.attributes import set_committed_value
+from app.models.course import Course
+from app.models.lesson import Lesson, LessonAttachment, FileKind, get_file_kind
 from app.schemas.lesson import LessonCreate, LessonUpdate, LessonAttachmentCreate
+from app.utils.path_helpers import get_file_url
 from typing import List, Optional
 
-def get_lesson(db: Session, lesson_id: int):
-    return db.query(Lesson).filter(Lesson.id == lesson_id).first()
+def _attachment_count_expr():
+    return select(func.count(LessonAttachment.id)).where(
+        LessonAttachment.lesson_id == Lesson.id
+    ).scalar_subquery()
 
-def get_lesson_with_attachments(db: Session, lesson_id: int):
-    return db.query(Lesson).options(
+async def get_lesson(db: AsyncSession, lesson_id: int):
+    result = await db.execute(select(Lesson).where(Lesson.id == lesson_id))
+    return result.scalars().first()
+
+async def get_lesson_with_attachments(db: AsyncSession, lesson_id: int):
+    result = await db.execute(select(Lesson).options(
         joinedload(Lesson.attachments)
-    ).filter(Lesson.id == lesson_id).first()
+    ).where(Lesson.id == lesson_id))
+    return result.unique().scalars().first()
+
+async def get_lesson_with_course_perms(db: AsyncSession, lesson_id: int, with_attachments: bool = False):
+    """Получить урок вместе с автором и статусом публикации курса одним запросом"""
+    query = select(Lesson, Course.author_id, Course.is_published).join(
+        Course, Lesson.course_id == Course.id
+    ).where(Lesson.id == lesson_id)
+    
+    if with_attachments:
+        query = query.options(
+            selectinload(Lesson.attachments),
+            with_expression(Lesson.attachment_count, _attachment_count_expr())
+        )
+    
+    result = await db.execute(query)
+    return result.first()
 
-def get_lessons_by_course(db: Session, course_id: int):
-    return db.query(Lesson).filter(
+async def get_lessons_by_course(db: AsyncSession, course_id: int):
+    result = await db.execute(select(Lesson).options(
+        selectinload(Lesson.attachments),
+        with_expression(Lesson.attachment_count, _attachment_count_expr())
+    ).where(
         Lesson.course_id == course_id
-    ).order_by(Lesson.order).all()
+    ).order_by(Lesson.order))
+    return result.scalars().all()
+
+async def get_lesson_ids_by_course(db: AsyncSession, course_id: int) -> List[int]:
+    result = await db.execute(select(Lesson.id).where(Lesson.course_id == course_id))
+    return result.scalars().all()
+
+def _owned_lesson_ids(user_id: int):
+    return select(Lesson.id).join(Course, Lesson.course_id == Course.id).where(Course.author_id == user_id)
+
+async def get_owned_lesson(db: AsyncSession, lesson_id: int, user_id: int, is_admin: bool = False):
+    """Получить урок, если пользователь автор его курса (админ видит любой урок)"""
+    query = select(Lesson).where(Lesson.id == lesson_id)
+    if not is_admin:
+        query = query.where(Lesson.id.in_(_owned_lesson_ids(user_id)))
+    
+    result = await db.execute(query)
+    return result.scalars().first()
 
-def create_lesson(db: Session, lesson: LessonCreate):
+async def create_lesson(db: AsyncSession, lesson: LessonCreate):
     db_lesson = Lesson(**lesson.dict())
     db.add(db_lesson)
-    db.commit()
-    db.refresh(db_lesson)
+    await db.commit()
+    await db.refresh(db_lesson, ["attachments"])
+    set_committed_value(db_lesson, "attachment_count", 0)
     return db_lesson
 
-def update_lesson(db: Session, lesson_id: int, lesson_update: LessonUpdate):
-    db_lesson = get_lesson(db, lesson_id)
+async def create_lessons(db: AsyncSession, lessons: List[LessonCreate]):
+    """Создать несколько уроков одним многострочным INSERT (в порядке переданного списка)"""
+    if not lessons:
+        return []
+    
+    result = await db.scalars(
+        insert(Lesson).returning(Lesson, sort_by_parameter_order=True),
+        [lesson.dict() for lesson in lessons]
+    )
+    db_lessons = result.all()
+    await db.commit()
+    return db_lessons
+
+async def update_lessons(db: AsyncSession, lessons_data: List[dict], commit: bool = True):
+    """Обновить несколько уроков одним UPDATE по первичному ключу (каждый словарь содержит id)"""
+    if not lessons_data:
+        return
+    
+    await db.execute(update(Lesson), lessons_data)
+    if commit:
+        await db.commit()
+
+async def update_lesson(db: AsyncSession, lesson_id: int, lesson_update: LessonUpdate):
+    db_lesson = await get_lesson(db, lesson_id)
     if not db_lesson:
         return None
     
@@ -33,62 +103,189 @@ def update_lesson(db: Session, lesson_id: int, lesson_update: LessonUpdate):
     for field, value in update_data.items():
         setattr(db_lesson, field, value)
     
-    db.commit()
-    db.refresh(db_lesson)
+    await db.commit()
+    await db.refresh(db_lesson, ["attachments"])
     return db_lesson
 
-def delete_lesson(db: Session, lesson_id: int):
-    db_lesson = get_lesson(db, lesson_id)
+async def update_owned_lesson(
+    db: AsyncSession,
+    lesson_id: int,
+    lesson_update: LessonUpdate,
+    user_id: int,
+    is_admin: bool = False
+):
+    """Обновить урок одним UPDATE с проверкой автора курса; None, если урока нет или он чужой"""
+    update_data = lesson_update.dict(exclude_unset=True)
+    if not update_data:
+        db_lesson = await get_owned_lesson(db, lesson_id, user_id, is_admin)
+    else:
+        stmt = update(Lesson).where(Lesson.id == lesson_id)
+        if not is_admin:
+            stmt = stmt.where(Lesson.id.in_(_owned_lesson_ids(user_id)))
+        
+        result = await db.execute(stmt.values(**update_data).returning(Lesson))
+        db_lesson = result.scalars().first()
+        await db.commit()
+    
     if db_lesson:
-        db.delete(db_lesson)
-        db.commit()
+        # with_expression не работает с RETURNING, а вложения все равно загружаются для ответа
+        await db.refresh(db_lesson, ["attachments"])
+        set_committed_value(db_lesson, "attachment_count", len(db_lesson.attachments))
     return db_lesson
 
-def create_attachment(db: Session, attachment: LessonAttachmentCreate):
-    db_attachment = LessonAttachment(**attachment.dict())
+async def delete_owned_lesson(db: AsyncSession, lesson_id: int, user_id: int, is_admin: bool = False):
+    # Удаление через ORM, чтобы сработал каскад вложений
+    db_lesson = await get_owned_lesson(db, lesson_id, user_id, is_admin)
+    if db_lesson:
+        await db.delete(db_lesson)
+        await db.commit()
+    return db_lesson
+
+async def delete_lessons(db: AsyncSession, lesson_ids: List[int], commit: bool = True):
+    """Удалить несколько уроков без вложений одним DELETE (тесты удаляются каскадом в БД)"""
+    if not lesson_ids:
+        return
+    
+    await db.execute(delete(Lesson).where(Lesson.id.in_(lesson_ids)))
+    if commit:
+        await db.commit()
+
+async def delete_lesson(db: AsyncSession, lesson_id: int):
+    db_lesson = await get_lesson(db, lesson_id)
+    if db_lesson:
+        await db.delete(db_lesson)
+        await db.commit()
+    return db_lesson
+
+async def create_attachment(db: AsyncSession, attachment: LessonAttachmentCreate):
+    db_attachment = LessonAttachment(
+        **attachment.dict(),
+        file_url=get_file_url(attachment.file_path),
+        file_kind=get_file_kind(attachment.mime_type, attachment.is_video)
+    )
     db.add(db_attachment)
-    db.commit()
-    db.refresh(db_attachment)
+    await db.commit()
+    await db.refresh(db_attachment)
     return db_attachment
 
-def get_attachment(db: Session, attachment_id: int):
-    return db.query(LessonAttachment).filter(LessonAttachment.id == attachment_id).first()
+async def create_attachments(db: AsyncSession, attachments: List[LessonAttachmentCreate], commit: bool = True):
+    """Создать несколько вложений одним многострочным INSERT"""
+    if not attachments:
+        return []
+    
+    result = await db.scalars(
+        insert(LessonAttachment).returning(LessonAttachment),
+        [
+            {
+                **attachment.dict(),
+                "file_url": get_file_url(attachment.file_path),
+                "file_kind": get_file_kind(attachment.mime_type, attachment.is_video)
+            }
+            for attachment in attachments
+        ]
+    )
+    db_attachments = result.all()
+    if commit:
+        await db.commit()
+    return db_attachments
+
+async def get_attachment(db: AsyncSession, attachment_id: int):
+    result = await db.execute(select(LessonAttachment).where(LessonAttachment.id == attachment_id))
+    return result.scalars().first()
 
-def get_attachments(db: Session, lesson_id: int):
-    return db.query(LessonAttachment).filter(
+async def get_attachments(db: AsyncSession, lesson_id: int):
+    result = await db.execute(select(LessonAttachment).where(
         LessonAttachment.lesson_id == lesson_id
-    ).all()
+    ))
+    return result.scalars().all()
 
-def get_attachments_by_type(db: Session, lesson_id: int, file_type: str = None):
+def _filter_attachments_by_type(query, file_type: Optional[str]):
+    # Равенство по file_kind использует индекс (lesson_id, file_kind) вместо LIKE по mime_type
+    try:
+        file_kind = FileKind(file_type)
+    except ValueError:
+        return query
+    return query.where(LessonAttachment.file_kind == file_kind.value)
+
+async def get_attachments_by_type(db: AsyncSession, lesson_id: int, file_type: str = None):
     """Получить вложения по типу файла"""
-    query = db.query(LessonAttachment).filter(LessonAttachment.lesson_id == lesson_id)
+    query = select(LessonAttachment).where(LessonAttachment.lesson_id == lesson_id)
+    query = _filter_attachments_by_type(query, file_type)
+    
+    result = await db.execute(query)
+    return result.scalars().all()
+
+async def get_attachment_rows(db: AsyncSession, lesson_id: int, file_type: Optional[str] = None):
+    """Получить вложения урока (с фильтром по типу) в виде словарей, без гидрации ORM-объектов"""
+    query = select(*LessonAttachment.__table__.columns).where(LessonAttachment.lesson_id == lesson_id)
+    query = _filter_attachments_by_type(query, file_type)
     
-    if file_type == 'image':
-        query = query.filter(LessonAttachment.mime_type.like('image/%'))
-    elif file_type == 'video':
-        query = query.filter(LessonAttachment.is_video == True)
-    elif file_type == 'document':
-        query = query.filter(
-            LessonAttachment.mime_type.like('application/%') | 
-            LessonAttachment.mime_type.like('text/%')
-        ).filter(LessonAttachment.is_video == False)
+    result = await db.execute(query)
+    return result.mappings().all()
+
+async def get_attachment_stats(db: AsyncSession, lesson_id: int):
+    """Агрегированная статистика по вложениям урока"""
+    is_external = or_(
+        LessonAttachment.file_path.like('http://%'),
+        LessonAttachment.file_path.like('https://%')
+    )
+    is_image = and_(not_(LessonAttachment.is_video), LessonAttachment.mime_type.like('image/%'))
+    is_document = and_(
+        not_(LessonAttachment.is_video),
+        or_(
+            LessonAttachment.mime_type.like('text/%'),
+            and_(
+                LessonAttachment.mime_type.like('application/%'),
+                not_(LessonAttachment.mime_type.like('application/octet-stream%'))
+            )
+        )
+    )
     
-    return query.all()
+    result = await db.execute(select(
+        func.count(LessonAttachment.id).label("total"),
+        func.coalesce(func.sum(LessonAttachment.file_size).filter(not_(is_external)), 0).label("total_size"),
+        func.count(LessonAttachment.id).filter(is_external).label("external_links"),
+        func.count(LessonAttachment.id).filter(LessonAttachment.is_video == True).label("videos"),
+        func.count(LessonAttachment.id).filter(is_image).label("images"),
+        func.count(LessonAttachment.id).filter(is_document).label("documents")
+    ).where(LessonAttachment.lesson_id == lesson_id))
+    return result.mappings().one()
 
-def delete_attachment(db: Session, attachment_id: int):
-    db_attachment = db.query(LessonAttachment).filter(
-        LessonAttachment.id == attachment_id
-    ).first()
+async def delete_attachment(db: AsyncSession, attachment_id: int):
+    db_attachment = await get_attachment(db, attachment_id)
     
     if db_attachment:
-        db.delete(db_attachment)
-        db.commit()
+        await db.delete(db_attachment)
+        await db.commit()
     
     return db_attachment
 
-def get_attachment_by_filename(db: Session, lesson_id: int, filename: str):
+async def delete_owned_attachment(
+    db: AsyncSession,
+    attachment_id: int,
+    lesson_id: int,
+    user_id: int,
+    is_admin: bool = False
+):
+    """Удалить вложение одним DELETE с проверкой автора курса.
+    Возвращает (file_path, course_id) или None, если вложения нет или оно чужое"""
+    stmt = delete(LessonAttachment).where(
+        LessonAttachment.id == attachment_id,
+        LessonAttachment.lesson_id == lesson_id
+    )
+    if not is_admin:
+        stmt = stmt.where(LessonAttachment.lesson_id.in_(_owned_lesson_ids(user_id)))
+    
+    course_id = select(Lesson.course_id).where(Lesson.id == lesson_id).scalar_subquery()
+    result = await db.execute(stmt.returning(LessonAttachment.file_path, course_id))
+    row = result.first()
+    await db.commit()
+    return row
+
+async def get_attachment_by_filename(db: AsyncSession, lesson_id: int, filename: str):
     """Получить вложение по имени файла"""
-    return db.query(LessonAttachment).filter(
+    result = await db.execute(select(LessonAttachment).where(
         LessonAttachment.lesson_id == lesson_id,
         LessonAttachment.file_name == filename
-    ).first()
\ No newline at end of file
+    ))
+    return result.scalars().first()
\ No newline at end of file
@@ -1,27 +1,49 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
 from app.models.user import User
+from app.models.quiz import Quiz, QuizAttempt
 from app.schemas.user import UserCreate, UserUpdate
-from app.core.security import get_password_hash, verify_password
+from app.core.security import get_password_hash_async, verify_password_async
 
-def get_user(db: Session, user_id: int):
-    return db.query(User).filter(User.id == user_id).first()
+async def get_user(db: AsyncSession, user_id: int):
+    result = await db.execute(select(User).where(User.id == user_id))
+    return result.scalars().first()
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    """Список пользователей по id. С after_id - keyset-пагинация по первичному ключу без OFFSET"""
+    query = select(User).order_by(User.id).limit(limit)
+    if after_id is not None:
+        query = query.where(User.id > after_id)
+    else:
+        query = query.offset(skip)
+    
+    result = await db.execute(query)
+    return result.scalars().all()
+
+async def get_user_is_active(db: AsyncSession, user_id: int, username: str):
+    # id может достаться новому пользователю после удаления, поэтому сверяется и username
+    result = await db.execute(select(User.is_active).where(User.id == user_id, User.username == username))
+    return result.scalar()
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user_by_username(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user_by_username(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return False
     return user
 
-def create_user(db: Session, user: UserCreate):
-    hashed_password = get_password_hash(user.password)
+async def create_user(db: AsyncSession, user: UserCreate):
+    hashed_password = await get_password_hash_async(user.password)
     db_user = User(
         email=user.email,
         username=user.username,
@@ -30,30 +52,34 @@ def create_user(db: Session, user: UserCreate):
         role=user.role
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
-def update_user(db: Session, user_id: int, user_update: UserUpdate):
-    db_user = get_user(db, user_id)
+async def update_user(db: AsyncSession, user_id: int, user_update: UserUpdate):
+    db_user = await get_user(db, user_id)
     if not db_user:
         return None
     
     update_data = user_update.dict(exclude_unset=True)
     
     if "password" in update_data:
-        update_data["hashed_password"] = get_password_hash(update_data.pop("password"))
+        update_data["hashed_password"] = await get_password_hash_async(update_data.pop("password"))
     
     for field, value in update_data.items():
         setattr(db_user, field, value)
     
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
-def delete_user(db: Session, user_id: int):
-    db_user = get_user(db, user_id)
+async def delete_user(db: AsyncSession, user_id: int):
+    db_user = await get_user(db, user_id)
     if db_user:
-        db.delete(db_user)
-        db.commit()
+        # В старых БД у внешних ключей нет ON DELETE, поэтому ссылки из тестов убираются явно:
+        # попытки пользователя удаляются, созданные им тесты остаются без автора
+        await db.execute(delete(QuizAttempt).where(QuizAttempt.user_id == user_id))
+        await db.execute(update(Quiz).where(Quiz.author_id == user_id).values(author_id=None))
+        await db.delete(db_user)
+        await db.commit()
     return db_user
\ No newline at end of file
@@ -1,19 +1,145 @@
-from sqlalchemy import create_engine
+from sqlalchemy import event, inspect, text
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from app.config import settings
 
-engine = create_engine(
-    settings.DATABASE_URL, 
-    connect_args={"check_same_thread": False}  # Только для SQLite
+def _async_database_url(url: str) -> str:
+    """Подставляет асинхронный драйвер в URL базы данных"""
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+def _is_sqlite_file(url: str) -> bool:
+    return url.startswith("sqlite") and ":memory:" not in url and not url.endswith("://")
+
+def _async_engine_options(url: str, pool_size: int = None, max_overflow: int = None) -> dict:
+    """Параметры пула соединений. Для файла SQLite пул задается явно (по умолчанию aiosqlite
+    открывает соединение и заново применяет PRAGMA на каждую сессию)"""
+    pool_options = {
+        "pool_size": pool_size or settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW if max_overflow is None else max_overflow,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE
+    }
+    if _is_sqlite_file(url):
+        return {
+            "connect_args": {"check_same_thread": False},
+            "poolclass": AsyncAdaptedQueuePool,
+            **pool_options
+        }
+    if url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False}}
+    return pool_options
+
+async_engine = create_async_engine(
+    _async_database_url(settings.DATABASE_URL),
+    pool_pre_ping=True,
+    **_async_engine_options(settings.DATABASE_URL)
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+# Отдельный пул читающих соединений: в режиме WAL читатели SQLite не ждут писателя.
+# Для других БД (и SQLite в памяти) чтение идет через основной движок
+if _is_sqlite_file(settings.DATABASE_URL):
+    async_read_engine = create_async_engine(
+        _async_database_url(settings.DATABASE_URL),
+        pool_pre_ping=True,
+        **_async_engine_options(settings.DATABASE_URL, pool_size=settings.DB_READ_POOL_SIZE, max_overflow=0)
+    )
+else:
+    async_read_engine = async_engine
+
+# Настройки SQLite для каждого нового соединения: WAL позволяет читать во время записи,
+# synchronous=NORMAL в режиме WAL убирает fsync на каждый коммит
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON"
+)
+
+# Читающие соединения дополнительно запрещают запись
+_SQLITE_READ_PRAGMAS = _SQLITE_PRAGMAS + ("PRAGMA query_only=ON",)
+
+def _listen_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
 
-def get_db():
-    db = SessionLocal()
-    try:
+if settings.DATABASE_URL.startswith("sqlite"):
+    _listen_sqlite_pragmas(async_engine, _SQLITE_PRAGMAS)
+    if async_read_engine is not async_engine:
+        _listen_sqlite_pragmas(async_read_engine, _SQLITE_READ_PRAGMAS)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
+Base = declarative_base(cls=AsyncAttrs)
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def get_read_db():
+    """Сессия для эндпоинтов, которые только читают"""
+    async with AsyncReadSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+async def init_db():
+    """Создает таблицы и доводит схему до текущих моделей"""
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(upgrade_schema)
+
+def upgrade_schema(conn):
+    """Доводит существующую БД до текущих моделей (create_all не добавляет колонки)"""
+    from app.utils.path_helpers import get_file_url
+    
+    columns = {column["name"] for column in inspect(conn).get_columns("lesson_attachments")}
+    if "file_url" not in columns:
+        conn.execute(text("ALTER TABLE lesson_attachments ADD COLUMN file_url VARCHAR"))
+        
+    # Заполняем file_url для вложений, загруженных до появления колонки
+    rows = conn.execute(text(
+        "SELECT id, file_path FROM lesson_attachments WHERE file_url IS NULL"
+    )).all()
+    if rows:
+        conn.execute(
+            text("UPDATE lesson_attachments SET file_url = :file_url WHERE id = :id"),
+            [{"id": row.id, "file_url": get_file_url(row.file_path)} for row in rows]
+        )
+        
+    # Тип вложения для вложений, загруженных до появления колонки file_kind
+    if "file_kind" not in columns:
+        conn.execute(text("ALTER TABLE lesson_attachments ADD COLUMN file_kind VARCHAR(16)"))
+    conn.execute(text(
+        "UPDATE lesson_attachments SET file_kind = CASE "
+        "WHEN is_video THEN 'video' "
+        "WHEN mime_type LIKE 'image/%' THEN 'image' "
+        "WHEN mime_type LIKE 'application/%' OR mime_type LIKE 'text/%' THEN 'document' "
+        "ELSE 'other' END "
+        "WHERE file_kind IS NULL"
+    ))
+        
+    quiz_columns = {column["name"] for column in inspect(conn).get_columns("quizzes")}
+    if "version" not in quiz_columns:
+        conn.execute(text("ALTER TABLE quizzes ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+    
+    # Уникальный индекс записей на курс не создастся, пока в старой БД есть дубли (их могла
+    # оставить гонка проверки и вставки при записи); от каждой пары остается самая ранняя запись
+    enrollment_indexes = {index["name"] for index in inspect(conn).get_indexes("course_enrollments")}
+    if "ix_course_enrollments_course_student" not in enrollment_indexes:
+        conn.execute(text(
+            "DELETE FROM course_enrollments WHERE id NOT IN "
+            "(SELECT MIN(id) FROM course_enrollments GROUP BY course_id, student_id)"
+        ))
+    
+    # create_all не добавляет индексы в существующие таблицы
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
\ No newline at end of file
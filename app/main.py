@@ -1,21 +1,25 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from anyio import to_thread
 from app.api.v1.router import api_router
 from app.config import settings
-from app.database import Base, engine
+from app.database import init_db, async_engine, async_read_engine
+from app.core.etag import compute_etag, etag_matches, not_modified
+from app.core.query_counter import QUERY_COUNT_WARN_THRESHOLD, count_queries, track_queries
 import os
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
-# Создаем таблицы в базе данных
-Base.metadata.create_all(bind=engine)
-
 app = FastAPI(
     title=settings.APP_NAME,
     version=settings.APP_VERSION,
-    debug=settings.DEBUG
+    debug=settings.DEBUG,
+    # Ответы сериализуются orjson (нативный код) вместо json.dumps
+    default_response_class=ORJSONResponse
 )
 
 # Настройка CORS
@@ -27,26 +31,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Создаем необходимые директории
-os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
-os.makedirs(os.path.join(settings.UPLOAD_DIR, "courses"), exist_ok=True)
-os.makedirs(os.path.join(settings.UPLOAD_DIR, "lessons"), exist_ok=True)
-os.makedirs(os.path.join(settings.UPLOAD_DIR, "scorm"), exist_ok=True)
+# Слишком большие загрузки отклоняем по Content-Length, не читая тело
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > settings.MAX_UPLOAD_SIZE:
+        return JSONResponse(status_code=413, content={"detail": "Request body too large"})
+    return await call_next(request)
+
+# В режиме отладки считаем SQL-запросы каждого HTTP-запроса: их рост выдает N+1
+if settings.DEBUG:
+    count_queries(async_engine)
+    if async_read_engine is not async_engine:
+        count_queries(async_read_engine)
+    
+    @app.middleware("http")
+    async def log_query_count(request: Request, call_next):
+        with track_queries() as counter:
+            response = await call_next(request)
+        response.headers["X-DB-Queries"] = str(counter[0])
+        if counter[0] > QUERY_COUNT_WARN_THRESHOLD:
+            logger.warning(f"{request.method} {request.url.path}: {counter[0]} SQL-запросов")
+        return response
 
-# Подключаем статические файлы
-app.mount("/uploads", StaticFiles(directory=settings.UPLOAD_DIR), name="uploads")
+# Подключаем статические файлы (каталог создается при старте)
+app.mount("/uploads", StaticFiles(directory=settings.UPLOAD_DIR, check_dir=False), name="uploads")
 
 # Подключаем роутеры
 app.include_router(api_router, prefix="/api/v1")
 
+@app.on_event("startup")
+async def run_migrations():
+    if not settings.RUN_MIGRATIONS:
+        return
+    
+    # Создаем таблицы в базе данных
+    await init_db()
+    
+    # Создаем необходимые директории
+    for subdir in ("", "courses", "lessons", "scorm"):
+        os.makedirs(os.path.join(settings.UPLOAD_DIR, subdir), exist_ok=True)
+
+@app.on_event("startup")
+async def configure_threadpool():
+    # Ограничиваем пул потоков Starlette/anyio размером пула соединений БД
+    to_thread.current_default_thread_limiter().total_tokens = settings.THREADPOOL_SIZE
+
+# Служебные ответы статичны: сериализуются и получают ETag один раз при загрузке модуля
+_ROOT_PAYLOAD = {
+    "message": "Welcome to LMS Platform API",
+    "version": settings.APP_VERSION,
+    "docs": "/docs"
+}
+_ROOT_BODY = orjson.dumps(_ROOT_PAYLOAD)
+_ROOT_ETAG = compute_etag(_ROOT_PAYLOAD)
+_HEALTH_BODY = orjson.dumps({"status": "healthy"})
+
 @app.get("/")
-async def root():
-    return {
-        "message": "Welcome to LMS Platform API",
-        "version": settings.APP_VERSION,
-        "docs": "/docs"
-    }
+async def root(request: Request):
+    if etag_matches(request, _ROOT_ETAG):
+        return not_modified(_ROOT_ETAG)
+    return Response(
+        content=_ROOT_BODY,
+        media_type="application/json",
+        headers={"ETag": _ROOT_ETAG, "Cache-Control": "public, max-age=60"}
+    )
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
\ No newline at end of file
+    # Без кэширования: прокси не должны отвечать на проверки живости вместо приложения
+    return Response(content=_HEALTH_BODY, media_type="application/json")
\ No newline at end of file
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Index, literal
+from sqlalchemy.orm import relationship, query_expression
 from sqlalchemy.dialects.sqlite import JSON
 from app.database import Base
 from datetime import datetime
@@ -15,10 +15,13 @@ class Course(Base):
     is_published = Column(Boolean, default=False)
     is_free = Column(Boolean, default=False)
     price = Column(Integer, default=0)  # В копейках/центах
-    author_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    author_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Количество уроков, подставляется запросом через with_expression
+    lesson_count = query_expression(default_expr=literal(0))
+    
     # Отношения
     author = relationship("User", back_populates="courses_authored", foreign_keys=[author_id])
     lessons = relationship("Lesson", back_populates="course", cascade="all, delete-orphan")
@@ -26,10 +29,14 @@ class Course(Base):
 
 class CourseEnrollment(Base):
     __tablename__ = "course_enrollments"
+    __table_args__ = (
+        # Один студент записывается на курс один раз; на индексе держится атомарная запись
+        Index("ix_course_enrollments_course_student", "course_id", "student_id", unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     course_id = Column(Integer, ForeignKey("courses.id"), nullable=False)
-    student_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    student_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     enrolled_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
     progress = Column(Integer, default=0)  # Процент завершения
@@ -1,11 +1,34 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Index, literal
+from sqlalchemy.orm import relationship, query_expression
 from sqlalchemy.dialects.sqlite import JSON
 from app.database import Base
 from datetime import datetime
+from typing import Optional
+import enum
+
+class FileKind(str, enum.Enum):
+    IMAGE = "image"
+    VIDEO = "video"
+    DOCUMENT = "document"
+    OTHER = "other"
+
+def get_file_kind(mime_type: Optional[str], is_video: bool) -> FileKind:
+    """Тип вложения для фильтрации (вычисляется при создании)"""
+    if is_video:
+        return FileKind.VIDEO
+    mime_type = mime_type or ""
+    if mime_type.startswith("image/"):
+        return FileKind.IMAGE
+    if mime_type.startswith(("application/", "text/")):
+        return FileKind.DOCUMENT
+    return FileKind.OTHER
 
 class Lesson(Base):
     __tablename__ = "lessons"
+    __table_args__ = (
+        # Уроки курса выбираются по course_id в порядке order
+        Index("ix_lessons_course_order", "course_id", "order"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, nullable=False)
@@ -18,7 +41,11 @@ class Lesson(Base):
     
     # Метаданные для SCORM
     scorm_data = Column(JSON, nullable=True)
-    quiz = relationship("Quiz", back_populates="lesson", uselist=False)
+    
+    # Количество вложений, подставляется запросом через with_expression
+    attachment_count = query_expression(default_expr=literal(0))
+    # Тест удаляется вместе с уроком по ON DELETE CASCADE (внешние ключи SQLite включены в database.py)
+    quiz = relationship("Quiz", back_populates="lesson", uselist=False, passive_deletes=True)
     
     # Отношения
     course = relationship("Course", back_populates="lessons")
@@ -26,14 +53,19 @@ class Lesson(Base):
 
 class LessonAttachment(Base):
     __tablename__ = "lesson_attachments"
+    __table_args__ = (
+        Index("ix_lesson_attachments_lesson_kind", "lesson_id", "file_kind"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     lesson_id = Column(Integer, ForeignKey("lessons.id"), nullable=False)
     file_name = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
+    file_url = Column(String)  # Публичный URL, вычисляется при загрузке
     file_size = Column(Integer)  # В байтах
     mime_type = Column(String)
     is_video = Column(Boolean, default=False)
+    file_kind = Column(String(16))  # FileKind, вычисляется при загрузке
     video_provider = Column(String)  # 'rutube', 'youtube', 'vimeo', 'uploaded'
     video_id = Column(String)  # ID видео на Rutube или другом сервисе
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -1,17 +1,25 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, ForeignKey, Float, DateTime
+from sqlalchemy import Column, Integer, String, Text, Boolean, ForeignKey, Float, DateTime, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from app.database import Base
+import secrets
+
+def _initial_version() -> int:
+    # Случайное начальное значение: id удаленного теста может достаться новому тесту,
+    # и ключ (quiz_id, version) кэша правильных ответов не должен совпасть со старым
+    return secrets.randbelow(2 ** 30)
 
 class Quiz(Base):
     __tablename__ = "quizzes"
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(200), nullable=False)
-    lesson_id = Column(Integer, ForeignKey("lessons.id", ondelete="CASCADE"))
-    author_id = Column(Integer, ForeignKey("users.id"))
+    lesson_id = Column(Integer, ForeignKey("lessons.id", ondelete="CASCADE"), index=True)
+    author_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Растет при каждом изменении вопросов и ответов (ключ кэша правильных ответов)
+    version = Column(Integer, nullable=False, default=_initial_version, server_default="0")
     
     # Отношения с каскадным удалением
     lesson = relationship("Lesson")
@@ -23,7 +31,7 @@ class Question(Base):
     __tablename__ = "questions"
     
     id = Column(Integer, primary_key=True, index=True)
-    quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"))
+    quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"), index=True)
     question_text = Column(Text, nullable=False)
     question_type = Column(String(50), default="single_choice")  # single_choice, multiple_choice
     
@@ -33,9 +41,18 @@ class Question(Base):
 
 class Answer(Base):
     __tablename__ = "answers"
+    __table_args__ = (
+        # Частичный индекс только по правильным ответам - для проверки теста
+        Index(
+            "ix_answers_correct",
+            "question_id",
+            sqlite_where=text("is_correct = 1"),
+            postgresql_where=text("is_correct")
+        ),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    question_id = Column(Integer, ForeignKey("questions.id", ondelete="CASCADE"))
+    question_id = Column(Integer, ForeignKey("questions.id", ondelete="CASCADE"), index=True)
     answer_text = Column(Text, nullable=False)
     is_correct = Column(Boolean, default=False)
     
@@ -44,10 +61,14 @@ class Answer(Base):
 
 class QuizAttempt(Base):
     __tablename__ = "quiz_attempts"
+    __table_args__ = (
+        # Последняя попытка пользователя по тесту - один проход по индексу
+        Index("ix_quiz_attempts_quiz_user_created", "quiz_id", "user_id", "created_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"))
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
     score = Column(Float, default=0)
     is_passed = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
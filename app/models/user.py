@@ -1,5 +1,6 @@
 from sqlalchemy import Boolean, Column, Integer, String, DateTime, Enum
 from sqlalchemy.orm import relationship
+from sqlalchemy.ext.hybrid import hybrid_property
 from app.database import Base
 from datetime import datetime
 import enum
@@ -17,11 +18,15 @@ class User(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     full_name = Column(String, nullable=False)
     hashed_password = Column(String, nullable=False)
-    role = Column(Enum(UserRole), default=UserRole.STUDENT, nullable=False)
+    role = Column(Enum(UserRole), default=UserRole.STUDENT, nullable=False, index=True)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    @hybrid_property
+    def is_admin(self):
+        return self.role == UserRole.ADMIN
+    
     # Отношения
     courses_authored = relationship("Course", back_populates="author", foreign_keys="Course.author_id")
     enrolled_courses = relationship("CourseEnrollment", back_populates="student")
\ No newline at end of file
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, validator
+from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 
@@ -50,10 +50,4 @@ class LessonInDB(LessonBase):
 
 class LessonResponse(LessonInDB):
     attachments: List[LessonAttachmentResponse] = []
-    attachment_count: int = 0
-    
-    @validator('attachment_count', always=True)
-    def compute_attachment_count(cls, v, values):
-        if 'attachments' in values:
-            return len(values['attachments'])
-        return 0
\ No newline at end of file
+    attachment_count: int = 0
\ No newline at end of file
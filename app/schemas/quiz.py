@@ -38,13 +38,41 @@ class QuizResponse(BaseModel):
     id: int
     title: str
     lesson_id: int
-    author_id: int
+    author_id: Optional[int]
     created_at: datetime
     questions: List[QuestionResponse]
     
     class Config:
         from_attributes = True
 
+# Получение для студента (без правильных ответов)
+class AnswerStudentResponse(BaseModel):
+    id: int
+    answer_text: str
+    
+    class Config:
+        from_attributes = True
+
+class QuestionStudentResponse(BaseModel):
+    id: int
+    question_text: str
+    question_type: str
+    answers: List[AnswerStudentResponse]
+    
+    class Config:
+        from_attributes = True
+
+class QuizStudentResponse(BaseModel):
+    id: int
+    title: str
+    lesson_id: int
+    author_id: Optional[int]
+    created_at: datetime
+    questions: List[QuestionStudentResponse]
+    
+    class Config:
+        from_attributes = True
+
 # Обновление
 class AnswerUpdate(BaseModel):
     id: Optional[int] = None  # Если None - новый ответ
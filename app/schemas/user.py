@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr, validator
-from typing import Optional
+from pydantic import BaseModel, EmailStr, StringConstraints
+from typing import Annotated, Optional
 from datetime import datetime
 from app.models.user import UserRole
 
@@ -10,13 +10,9 @@ class UserBase(BaseModel):
     role: UserRole = UserRole.STUDENT
 
 class UserCreate(UserBase):
-    password: str
-    
-    @validator('password')
-    def password_strength(cls, v):
-        if len(v) < 8:
-            raise ValueError('Password must be at least 8 characters long')
-        return v
+    # Ограничения проверяются в pydantic-core, без вызова Python-валидатора;
+    # верхняя граница не дает хэшировать и разбирать строки произвольной длины
+    password: Annotated[str, StringConstraints(min_length=8, max_length=1024)]
 
 class UserUpdate(BaseModel):
     email: Optional[EmailStr] = None
@@ -36,6 +32,17 @@ class UserInDB(UserBase):
 class UserResponse(UserInDB):
     pass
 
+class CurrentUser(BaseModel):
+    """Пользователь из claims токена, без загрузки строки users"""
+    id: int
+    username: str
+    role: UserRole
+    is_active: bool = True
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role == UserRole.ADMIN
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -1,18 +1,58 @@
 import os
+import re
 import shutil
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 import aiofiles
+import anyio
 from fastapi import UploadFile
 import magic
+from app.config import settings
+
+# Загрузки пишутся на диск блоками, не целиком в память
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Ссылки Rutube: rutube.ru/video/<id>/, rutube.ru/play/embed/<id>, rutube.ru/video/embed/<id>
+_RUTUBE_ID_RE = re.compile(r'rutube\.ru/(?:video/([a-f0-9]+)/|(?:play|video)/embed/([a-f0-9]+))')
 
 class FileService:
     def __init__(self, base_upload_dir: str = "./uploads"):
         self.base_upload_dir = Path(base_upload_dir)
         self.base_upload_dir.mkdir(parents=True, exist_ok=True)
+        # Загрузка базы libmagic дорогая, а дескриптор не потокобезопасен, поэтому у каждого потока свой
+        self._local = threading.local()
+    
+    @property
+    def mime_detector(self) -> magic.Magic:
+        mime = getattr(self._local, "magic", None)
+        if mime is None:
+            mime = self._local.magic = magic.Magic(mime=True)
+        return mime
+    
+    async def write_upload_file(self, upload_file: UploadFile, file_path: Path) -> int:
+        """Потоково записывает загруженный файл на диск, возвращает размер в байтах"""
+        size = 0
+        try:
+            async with aiofiles.open(file_path, 'wb') as out_file:
+                while chunk := await upload_file.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > settings.MAX_UPLOAD_SIZE:
+                        raise ValueError(f"Файл больше {settings.MAX_UPLOAD_SIZE} байт")
+                    await out_file.write(chunk)
+        except Exception:
+            # Не оставляем недописанный файл
+            file_path.unlink(missing_ok=True)
+            raise
+        return size
     
     async def save_upload_file(self, upload_file: UploadFile, subdir: str = "") -> Optional[Path]:
         """Сохраняет загруженный файл"""
+        saved = await self.save_upload_file_with_size(upload_file, subdir)
+        return saved[0] if saved else None
+    
+    async def save_upload_file_with_size(self, upload_file: UploadFile, subdir: str = "") -> Optional[Tuple[Path, int]]:
+        """Сохраняет загруженный файл и возвращает путь и размер (подсчитан при записи, без stat)"""
         try:
             # Создаем поддиректорию
             upload_dir = self.base_upload_dir / subdir
@@ -24,11 +64,9 @@ class FileService:
             file_path = upload_dir / unique_filename
             
             # Сохраняем файл
-            async with aiofiles.open(file_path, 'wb') as out_file:
-                content = await upload_file.read()
-                await out_file.write(content)
+            size = await self.write_upload_file(upload_file, file_path)
             
-            return file_path
+            return file_path, size
             
         except Exception as e:
             print(f"Ошибка при сохранении файла: {e}")
@@ -36,13 +74,20 @@ class FileService:
     
     def get_file_mime_type(self, file_path: Path) -> str:
         """Определяет MIME тип файла"""
-        mime = magic.Magic(mime=True)
-        return mime.from_file(str(file_path))
+        return self.mime_detector.from_file(str(file_path))
     
     def get_file_size(self, file_path: Path) -> int:
         """Возвращает размер файла в байтах"""
         return file_path.stat().st_size
     
+    async def get_file_mime_type_async(self, file_path: Path) -> str:
+        """Определяет MIME тип файла в пуле потоков"""
+        return await anyio.to_thread.run_sync(self.get_file_mime_type, file_path)
+    
+    async def get_file_size_async(self, file_path: Path) -> int:
+        """Возвращает размер файла в пуле потоков"""
+        return await anyio.to_thread.run_sync(self.get_file_size, file_path)
+    
     def delete_file(self, file_path: str) -> bool:
         """Удаляет файл"""
         try:
@@ -56,18 +101,8 @@ class FileService:
     
     def extract_rutube_id(self, url: str) -> Optional[str]:
         """Извлекает ID видео из ссылки Rutube"""
-        import re
-        
-        # Паттерны для Rutube
-        patterns = [
-            r'rutube\.ru/video/([a-f0-9]+)/',
-            r'rutube\.ru/play/embed/([a-f0-9]+)',
-            r'rutube\.ru/video/embed/([a-f0-9]+)'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, url)
-            if match:
-                return match.group(1)
+        match = _RUTUBE_ID_RE.search(url)
+        if match:
+            return match.group(1) or match.group(2)
         
         return None
\ No newline at end of file
@@ -1,11 +1,32 @@
+import hashlib
+import threading
+import anyio
 import markdown
+from cachetools import LRUCache
 from markdown.extensions.tables import TableExtension
 from markdown.extensions.codehilite import CodeHiliteExtension
 from markdown.extensions.fenced_code import FencedCodeExtension
 
 class MarkdownService:
-    def __init__(self):
-        self.md = markdown.Markdown(
+    def __init__(self, cache_size: int = 512):
+        # Экземпляр Markdown хранит состояние, поэтому у каждого потока свой
+        self._local = threading.local()
+        # Готовый HTML по хэшу исходного текста; используется только из цикла событий
+        self._html_cache = LRUCache(maxsize=cache_size)
+    
+    @staticmethod
+    def content_hash(markdown_text: str) -> str:
+        return hashlib.blake2b(markdown_text.encode(), digest_size=16).hexdigest()
+    
+    @property
+    def md(self) -> markdown.Markdown:
+        md = getattr(self._local, "md", None)
+        if md is None:
+            md = self._local.md = self._create_markdown()
+        return md
+    
+    def _create_markdown(self) -> markdown.Markdown:
+        return markdown.Markdown(
             extensions=[
                 'extra',
                 'abbr',
@@ -30,7 +51,17 @@ class MarkdownService:
     
     def convert_to_html(self, markdown_text: str) -> str:
         """Конвертирует Markdown в HTML"""
-        return self.md.convert(markdown_text)
+        return self.md.reset().convert(markdown_text)
+    
+    async def convert_to_html_async(self, markdown_text: str) -> str:
+        """Конвертирует Markdown в HTML в пуле потоков (парсер нагружает CPU).
+        Повторный текст берется из кэша процесса без конвертации"""
+        key = self.content_hash(markdown_text)
+        html = self._html_cache.get(key)
+        if html is None:
+            html = await anyio.to_thread.run_sync(self.convert_to_html, markdown_text)
+            self._html_cache[key] = html
+        return html
     
     def sanitize_markdown(self, markdown_text: str) -> str:
         """Очищает Markdown от потенциально опасного содержимого"""
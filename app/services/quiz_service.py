@@ -1,18 +1,54 @@
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from fastapi import HTTPException
 from typing import List, Dict, Optional
-from sqlalchemy import and_
+from sqlalchemy import and_, delete, insert, select, update
+from cachetools import LRUCache
 
+from app.core.cache import invalidate_quiz
 from app.models.quiz import Quiz, Question, Answer, QuizAttempt
-from app.models.user import User
 from app.schemas.quiz import QuizCreate, QuizUpdate, QuizSubmit
 
+# Правильные ответы тестов по ключу (quiz_id, version). Любое изменение вопросов повышает
+# Quiz.version, поэтому устаревшие записи не читаются и со временем вытесняются
+_correct_answers_cache = LRUCache(maxsize=1024)
+
+def _forget_correct_answers(quiz_id: int) -> None:
+    """Удаляет из кэша все версии правильных ответов теста"""
+    for key in [key for key in _correct_answers_cache if key[0] == quiz_id]:
+        del _correct_answers_cache[key]
+
 class QuizService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
     
+    async def _insert_questions(self, quiz_id: int, questions: List[Dict]) -> None:
+        """Вставка вопросов и их ответов двумя многострочными INSERT вместо flush на каждую строку"""
+        if not questions:
+            return
+        
+        result = await self.db.scalars(
+            insert(Question).returning(Question.id, sort_by_parameter_order=True),
+            [
+                {
+                    "quiz_id": quiz_id,
+                    "question_text": question["question_text"],
+                    "question_type": question["question_type"]
+                }
+                for question in questions
+            ]
+        )
+        
+        answer_rows = [
+            {"question_id": question_id, **answer}
+            for question_id, question in zip(result.all(), questions)
+            for answer in question["answers"]
+        ]
+        if answer_rows:
+            await self.db.execute(insert(Answer), answer_rows)
+    
     # === Создание теста ===
-    def create_quiz(self, lesson_id: int, quiz_data: QuizCreate, author_id: int) -> Quiz:
+    async def create_quiz(self, lesson_id: int, quiz_data: QuizCreate, author_id: int) -> Quiz:
         """Создание теста для урока"""
         quiz = Quiz(
             title=quiz_data.title,
@@ -21,64 +57,69 @@ class QuizService:
         )
         
         self.db.add(quiz)
-        self.db.flush()
-        
-        for question_data in quiz_data.questions:
-            question = Question(
-                quiz_id=quiz.id,
-                question_text=question_data.question_text,
-                question_type=question_data.question_type
-            )
-            self.db.add(question)
-            self.db.flush()
-            
-            for answer_data in question_data.answers:
-                answer = Answer(
-                    question_id=question.id,
-                    answer_text=answer_data.answer_text,
-                    is_correct=answer_data.is_correct
-                )
-                self.db.add(answer)
-        
-        self.db.commit()
-        self.db.refresh(quiz)
+        await self.db.flush()
+        
+        await self._insert_questions(quiz.id, [
+            {
+                "question_text": question_data.question_text,
+                "question_type": question_data.question_type,
+                "answers": [
+                    {"answer_text": answer_data.answer_text, "is_correct": answer_data.is_correct}
+                    for answer_data in question_data.answers
+                ]
+            }
+            for question_data in quiz_data.questions
+        ])
+        
+        await self.db.commit()
         return quiz
     
     # === Получение теста ===
-    def get_quiz(self, quiz_id: int, include_answers: bool = True) -> Optional[Quiz]:
-        """Получение теста по ID"""
-        query = self.db.query(Quiz).filter(Quiz.id == quiz_id)
+    def _quiz_query(self, include_answers: bool):
+        query = select(Quiz)
         
         if include_answers:
-            # Используем joinedload для загрузки всех связанных данных
+            # Вопросы и ответы загружаются двумя IN-запросами, без N+1 и размножения строк JOIN
             query = query.options(
-                joinedload(Quiz.questions).joinedload(Question.answers)
+                selectinload(Quiz.questions).selectinload(Question.answers)
             )
         
-        quiz = query.first()
+        return query
+    
+    async def get_quiz(self, quiz_id: int, include_answers: bool = True) -> Optional[Quiz]:
+        """Получение теста по ID"""
+        query = self._quiz_query(include_answers).where(Quiz.id == quiz_id)
+        quiz = (await self.db.scalars(query)).first()
         
         if not quiz:
             return None
         
         return quiz
     
-    def get_quiz_by_lesson(self, lesson_id: int) -> Optional[Quiz]:
+    async def get_quiz_by_lesson(self, lesson_id: int, include_answers: bool = False) -> Optional[Quiz]:
         """Получение теста для урока"""
-        return self.db.query(Quiz).filter(Quiz.lesson_id == lesson_id).first()
+        result = await self.db.scalars(self._quiz_query(include_answers).where(Quiz.lesson_id == lesson_id))
+        return result.first()
+    
+    async def get_quiz_keys_by_lessons(self, lesson_ids: List[int]) -> List[tuple]:
+        """Пары (quiz_id, lesson_id) тестов уроков - для сброса кэша перед каскадным удалением"""
+        if not lesson_ids:
+            return []
+        result = await self.db.execute(select(Quiz.id, Quiz.lesson_id).where(Quiz.lesson_id.in_(lesson_ids)))
+        return result.all()
     
     # === Обновление теста ===
-    def update_quiz(self, quiz_id: int, update_data: QuizUpdate, user_id: int) -> Quiz:
+    async def update_quiz(self, quiz_id: int, update_data: QuizUpdate, user_id: int, is_admin: bool = False) -> Quiz:
         """Обновление теста - ПРАВИЛЬНОЕ УДАЛЕНИЕ СТАРЫХ ВОПРОСОВ И ОТВЕТОВ"""
-        quiz = self.get_quiz(quiz_id, include_answers=True)
+        # Вопросы не загружаются: старые удаляются массовым DELETE
+        quiz = await self.get_quiz(quiz_id, include_answers=False)
         
         if not quiz:
             raise HTTPException(status_code=404, detail="Quiz not found")
         
         # Проверяем права
-        if quiz.author_id != user_id:
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user or not user.is_admin:
-                raise HTTPException(status_code=403, detail="Not authorized")
+        if quiz.author_id != user_id and not is_admin:
+            raise HTTPException(status_code=403, detail="Not authorized")
         
         # Обновляем заголовок
         if update_data.title is not None:
@@ -86,76 +127,73 @@ class QuizService:
         
         # Обновляем вопросы, если они переданы
         if update_data.questions is not None:
-            # ПРАВИЛЬНЫЙ СПОСОБ: удаляем старые вопросы и ответы
-            # Это сработает благодаря cascade="all, delete-orphan"
-            
-            # 1. Очищаем все вопросы (ответы удалятся каскадно)
-            for question in list(quiz.questions):  # Создаем копию списка
-                self.db.delete(question)
+            # Новая версия теста делает недействительным кэш правильных ответов
+            quiz.version = Quiz.version + 1
             
-            self.db.flush()  # Выполняем удаление
+            # 1. Удаляем старые ответы и вопросы двумя массовыми DELETE
+            # вместо отдельного DELETE на каждую строку при каскаде через ORM
+            question_ids = select(Question.id).where(Question.quiz_id == quiz.id)
+            await self.db.execute(
+                delete(Answer).where(Answer.question_id.in_(question_ids)),
+                execution_options={"synchronize_session": False}
+            )
+            await self.db.execute(
+                delete(Question).where(Question.quiz_id == quiz.id),
+                execution_options={"synchronize_session": False}
+            )
             
-            # 2. Создаем новые вопросы
-            for question_data in update_data.questions:
-                if question_data.question_text is None:
-                    continue
-                    
-                question = Question(
-                    quiz_id=quiz.id,
-                    question_text=question_data.question_text,
-                    question_type=question_data.question_type or "single_choice"
-                )
-                self.db.add(question)
-                self.db.flush()  # Получаем ID вопроса
-                
-                # 3. Создаем новые ответы
-                if question_data.answers:
-                    for answer_data in question_data.answers:
-                        if answer_data.answer_text is None:
-                            continue
-                            
-                        answer = Answer(
-                            question_id=question.id,
-                            answer_text=answer_data.answer_text,
-                            is_correct=answer_data.is_correct or False
-                        )
-                        self.db.add(answer)
-        
-        self.db.commit()
-        self.db.refresh(quiz)
+            # 2. Создаем новые вопросы и ответы
+            await self._insert_questions(quiz.id, [
+                {
+                    "question_text": question_data.question_text,
+                    "question_type": question_data.question_type or "single_choice",
+                    "answers": [
+                        {"answer_text": answer_data.answer_text, "is_correct": answer_data.is_correct or False}
+                        for answer_data in question_data.answers or []
+                        if answer_data.answer_text is not None
+                    ]
+                }
+                for question_data in update_data.questions
+                if question_data.question_text is not None
+            ])
+        
+        await self.db.commit()
+        await invalidate_quiz(quiz.id, quiz.lesson_id)
         return quiz
     
     # === Удаление теста ===
-    def delete_quiz(self, quiz_id: int, user_id: int) -> bool:
+    async def delete_quiz(self, quiz_id: int, user_id: int, is_admin: bool = False) -> bool:
         """Удаление теста - СРАБОТАЕТ КАСКАДНОЕ УДАЛЕНИЕ"""
-        quiz = self.db.query(Quiz).filter(Quiz.id == quiz_id).first()
+        # Каскадно удаляемые связи загружаются заранее: ленивая загрузка в AsyncSession недоступна
+        quiz = (await self.db.scalars(select(Quiz).options(
+            selectinload(Quiz.questions).selectinload(Question.answers),
+            selectinload(Quiz.attempts)
+        ).where(Quiz.id == quiz_id))).first()
         
         if not quiz:
             raise HTTPException(status_code=404, detail="Quiz not found")
         
         # Проверяем права
-        if quiz.author_id != user_id:
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user or not user.is_admin:
-                raise HTTPException(status_code=403, detail="Not authorized")
+        if quiz.author_id != user_id and not is_admin:
+            raise HTTPException(status_code=403, detail="Not authorized")
         
         # Удаляем тест (вопросы и ответы удалятся каскадно)
-        self.db.delete(quiz)
-        self.db.commit()
+        await self.db.delete(quiz)
+        await self.db.commit()
+        _forget_correct_answers(quiz.id)
+        await invalidate_quiz(quiz.id, quiz.lesson_id)
         return True
     
     # === Частичное обновление (альтернативный метод) ===
-    def update_quiz_partial(self, quiz_id: int, update_data: QuizUpdate, user_id: int) -> Quiz:
+    async def update_quiz_partial(self, quiz_id: int, update_data: QuizUpdate, user_id: int, is_admin: bool = False) -> Quiz:
         """Частичное обновление теста (только измененные поля)"""
-        quiz = self.get_quiz(quiz_id, include_answers=True)
+        quiz = await self.get_quiz(quiz_id, include_answers=True)
         
         if not quiz:
             raise HTTPException(status_code=404, detail="Quiz not found")
         
-        if quiz.author_id != user_id:
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user or not user.is_admin:
-                raise HTTPException(status_code=403, detail="Not authorized")
+        if quiz.author_id != user_id and not is_admin:
+            raise HTTPException(status_code=403, detail="Not authorized")
         
         # Обновляем заголовок
         if update_data.title is not None:
@@ -163,99 +201,115 @@ class QuizService:
         
         # Если переданы вопросы - полное обновление
         if update_data.questions is not None:
-            return self.update_quiz(quiz_id, update_data, user_id)
+            return await self.update_quiz(quiz_id, update_data, user_id, is_admin)
         
-        self.db.commit()
-        self.db.refresh(quiz)
+        await self.db.commit()
+        await invalidate_quiz(quiz.id, quiz.lesson_id)
         return quiz
     
     # === Удаление отдельных ответов ===
-    def delete_answer(self, answer_id: int, user_id: int) -> bool:
+    async def delete_answer(self, answer_id: int, user_id: int, is_admin: bool = False) -> bool:
         """Удаление конкретного ответа"""
-        answer = self.db.query(Answer).filter(Answer.id == answer_id).first()
-        
-        if not answer:
-            raise HTTPException(status_code=404, detail="Answer not found")
-        
-        # Получаем вопрос и тест для проверки прав
-        question = self.db.query(Question).filter(Question.id == answer.question_id).first()
-        if not question:
-            raise HTTPException(status_code=404, detail="Question not found")
+        # Тест для проверки прав выбирается вместе с ответом одним JOIN
+        quiz = (await self.db.execute(
+            select(Quiz.id, Quiz.lesson_id, Quiz.author_id)
+            .join(Question, Question.quiz_id == Quiz.id)
+            .join(Answer, Answer.question_id == Question.id)
+            .where(Answer.id == answer_id)
+        )).first()
         
-        quiz = self.get_quiz(question.quiz_id, include_answers=False)
         if not quiz:
-            raise HTTPException(status_code=404, detail="Quiz not found")
+            raise HTTPException(status_code=404, detail="Answer not found")
         
         # Проверяем права
-        if quiz.author_id != user_id:
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user or not user.is_admin:
-                raise HTTPException(status_code=403, detail="Not authorized")
+        if quiz.author_id != user_id and not is_admin:
+            raise HTTPException(status_code=403, detail="Not authorized")
         
         # Удаляем ответ
-        self.db.delete(answer)
-        self.db.commit()
+        await self.db.execute(delete(Answer).where(Answer.id == answer_id))
+        await self._bump_version(quiz.id)
+        await self.db.commit()
+        await invalidate_quiz(quiz.id, quiz.lesson_id)
         return True
     
     # === Удаление отдельных вопросов ===
-    def delete_question(self, question_id: int, user_id: int) -> bool:
+    async def delete_question(self, question_id: int, user_id: int, is_admin: bool = False) -> bool:
         """Удаление вопроса (с ответами удалятся каскадно)"""
-        question = self.db.query(Question).filter(Question.id == question_id).first()
+        # Тест для проверки прав выбирается вместе с вопросом одним JOIN
+        quiz = (await self.db.execute(
+            select(Quiz.id, Quiz.lesson_id, Quiz.author_id)
+            .join(Question, Question.quiz_id == Quiz.id)
+            .where(Question.id == question_id)
+        )).first()
         
-        if not question:
-            raise HTTPException(status_code=404, detail="Question not found")
-        
-        # Получаем тест для проверки прав
-        quiz = self.get_quiz(question.quiz_id, include_answers=False)
         if not quiz:
-            raise HTTPException(status_code=404, detail="Quiz not found")
+            raise HTTPException(status_code=404, detail="Question not found")
         
         # Проверяем права
-        if quiz.author_id != user_id:
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user or not user.is_admin:
-                raise HTTPException(status_code=403, detail="Not authorized")
-        
-        # Удаляем вопрос (ответы удалятся каскадно)
-        self.db.delete(question)
-        self.db.commit()
+        if quiz.author_id != user_id and not is_admin:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        
+        # Удаляем ответы и вопрос массовыми DELETE, без загрузки строк
+        await self.db.execute(delete(Answer).where(Answer.question_id == question_id))
+        await self.db.execute(delete(Question).where(Question.id == question_id))
+        await self._bump_version(quiz.id)
+        await self.db.commit()
+        await invalidate_quiz(quiz.id, quiz.lesson_id)
         return True
     
     # === Проверка ответов ===
-    def submit_quiz(self, quiz_id: int, submit_data: QuizSubmit, user_id: int) -> Dict:
-        """Проверка ответов пользователя"""
-        quiz = self.get_quiz(quiz_id, include_answers=True)
-        if not quiz:
-            raise HTTPException(status_code=404, detail="Quiz not found")
+    async def _bump_version(self, quiz_id: int) -> None:
+        await self.db.execute(update(Quiz).where(Quiz.id == quiz_id).values(version=Quiz.version + 1))
+    
+    async def _get_correct_answers(self, quiz_id: int) -> Optional[Dict[int, frozenset]]:
+        """Множества правильных ответов по вопросам теста; None, если теста нет"""
+        version = await self.db.scalar(select(Quiz.version).where(Quiz.id == quiz_id))
+        if version is None:
+            return None
         
-        questions = quiz.questions
+        correct_answers = _correct_answers_cache.get((quiz_id, version))
+        if correct_answers is not None:
+            return correct_answers
+        
+        # Одним запросом: вопросы теста и только их правильные ответы (без загрузки ORM-объектов).
+        # Версия выбирается в том же запросе, чтобы ключ кэша соответствовал данным
+        rows = (await self.db.execute(
+            select(Quiz.version, Question.id.label("question_id"), Answer.id.label("answer_id"))
+            .outerjoin(Question, Question.quiz_id == Quiz.id)
+            .outerjoin(Answer, and_(Answer.question_id == Question.id, Answer.is_correct == True))
+            .where(Quiz.id == quiz_id)
+        )).all()
+        if not rows:
+            return None
         
-        # Подготавливаем словарь правильных ответов
-        correct_answers = {}
-        for question in questions:
-            correct_answers[question.id] = []
-            for answer in question.answers:
-                if answer.is_correct:
-                    correct_answers[question.id].append(answer.id)
+        answer_sets = {}
+        for row in rows:
+            if row.question_id is None:
+                continue
+            correct_ids = answer_sets.setdefault(row.question_id, set())
+            if row.answer_id is not None:
+                correct_ids.add(row.answer_id)
+        
+        correct_answers = {question_id: frozenset(ids) for question_id, ids in answer_sets.items()}
+        _correct_answers_cache[(quiz_id, rows[0].version)] = correct_answers
+        return correct_answers
+    
+    async def submit_quiz(self, quiz_id: int, submit_data: QuizSubmit, user_id: int) -> Dict:
+        """Проверка ответов пользователя"""
+        correct_answers = await self._get_correct_answers(quiz_id)
+        if correct_answers is None:
+            raise HTTPException(status_code=404, detail="Quiz not found")
         
         # Проверяем ответы пользователя
-        total_questions = len(questions)
+        total_questions = len(correct_answers)
         correct_count = 0
         
+        # Ответ засчитывается, если выбраны ровно правильные варианты; это верно и для
+        # single_choice (один правильный), и для multiple_choice, поэтому тип вопроса не нужен
         for user_answer in submit_data.answers:
-            question_id = user_answer.question_id
-            selected_ids = set(user_answer.selected_answer_ids)
-            correct_ids = set(correct_answers.get(question_id, []))
-            question = next((q for q in questions if q.id == question_id), None)
-            if not question:
-                continue
-            if question.question_type == "single":
-                if len(selected_ids) == 1 and selected_ids.issubset(correct_ids):
-                    correct_count += 1
-            
-            elif question.question_type == "multiple":
-                if selected_ids == correct_ids:
-                    correct_count += 1
+            correct_ids = correct_answers.get(user_answer.question_id)
+            if correct_ids and set(user_answer.selected_answer_ids) == correct_ids:
+                correct_count += 1
         # Вычисляем результат
         score = correct_count / total_questions if total_questions > 0 else 0
         is_passed = score >= 0.7
@@ -268,7 +322,7 @@ class QuizService:
             is_passed=is_passed
         )
         self.db.add(attempt)
-        self.db.commit()
+        await self.db.commit()
         
         return {
             "score": score,
@@ -277,12 +331,15 @@ class QuizService:
             "correct_answers": correct_count
         }
     
-    def get_user_result(self, quiz_id: int, user_id: int) -> Dict:
+    async def get_user_result(self, quiz_id: int, user_id: int) -> Dict:
         """Получение результата пользователя"""
-        attempt = self.db.query(QuizAttempt).filter(
-            QuizAttempt.quiz_id == quiz_id,
-            QuizAttempt.user_id == user_id
-        ).order_by(QuizAttempt.created_at.desc()).first()
+        # Последняя попытка - один проход по индексу (quiz_id, user_id, created_at), без ORM-объекта
+        attempt = (await self.db.execute(
+            select(QuizAttempt.score, QuizAttempt.is_passed, QuizAttempt.created_at)
+            .where(QuizAttempt.quiz_id == quiz_id, QuizAttempt.user_id == user_id)
+            .order_by(QuizAttempt.created_at.desc())
+            .limit(1)
+        )).first()
         
         if not attempt:
             return {"message": "No attempts found"}
@@ -1,5 +1,8 @@
 import zipfile
-import xml.etree.ElementTree as ET
+import codecs
+import fnmatch
+from lxml import etree as LET
+from lxml import html as LH
 from pathlib import Path
 import json
 import shutil
@@ -7,11 +10,419 @@ from typing import Dict, Any, Optional, List, Tuple
 import os
 import re
 import logging
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import hashlib
 from urllib.parse import urlparse, unquote
+from cachetools import LRUCache
 
 logger = logging.getLogger(__name__)
 
+# Кодировку из XML-декларации или BOM libxml2 определяет сам (None);
+# остальные - для старых манифестов без декларации, latin-1 декодирует любые байты
+_MANIFEST_FALLBACK_ENCODINGS = ('utf-8', 'cp1251')
+_XML_BOMS = (b'\xef\xbb\xbf', b'\xff\xfe', b'\xfe\xff')
+_XML_DECLARED_ENCODING_RE = re.compile(rb'\s*<\?xml[^>]*encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
+def _manifest_encoding(manifest_path: Path) -> Optional[str]:
+    """Кодировка для разбора манифеста: None при BOM или декларации, иначе первая,
+    в которой декодируются байты файла (проверка декодированием, без разбора XML)"""
+    with open(manifest_path, 'rb') as f:
+        head = f.read(256)
+        if head.startswith(_XML_BOMS) or _XML_DECLARED_ENCODING_RE.match(head):
+            return None
+        if len(head) < 256:
+            return _decodable_encoding(head)
+        # Файл проверяется прямо из отображения в память, без копии в bytes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _decodable_encoding(mapped)
+    
+def _decodable_encoding(data) -> str:
+    """Первая из запасных кодировок, в которой данные декодируются без ошибок"""
+    for encoding in _MANIFEST_FALLBACK_ENCODINGS:
+        try:
+            codecs.decode(data, encoding)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return 'latin-1'
+
+def _read_text(file_path, encoding: str, errors: str) -> str:
+    """Текст файла целиком. Декодируется прямо из mmap, без промежуточной копии в bytes;
+    переводы строк приводятся к '\\n', как при чтении в текстовом режиме"""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            content = codecs.decode(mapped, encoding, errors)
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+# Теги SCORM с namespace, как их отдает lxml
+_IMSCP = '{http://www.imsglobal.org/xsd/imscp_v1p1}'
+_IMSMD = '{http://www.imsglobal.org/xsd/imsmd_v1p2}'
+_ORGANIZATIONS_TAG = _IMSCP + 'organizations'
+_ORGANIZATION_TAG = _IMSCP + 'organization'
+_RESOURCES_TAG = _IMSCP + 'resources'
+_RESOURCE_TAG = _IMSCP + 'resource'
+_FILE_TAG = _IMSCP + 'file'
+_TITLE_TAG = _IMSCP + 'title'
+_MD_TITLE_TAG = _IMSMD + 'title'
+_MD_DESCRIPTION_TAG = _IMSMD + 'description'
+
+_HTML_EXTENSIONS = frozenset({'html', 'htm'})
+_IMAGE_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png', 'gif', 'bmp', 'svg', 'webp'})
+
+def _file_kind(file_name: str) -> str:
+    """Тип файла пакета по расширению: 'html', 'image' или 'other'"""
+    extension = file_name.rsplit('.', 1)[-1].lower()
+    if extension in _HTML_EXTENSIONS:
+        return 'html'
+    if extension in _IMAGE_EXTENSIONS:
+        return 'image'
+    return 'other'
+
+def _walk_files(root: str) -> List[str]:
+    """Обычные файлы дерева одним обходом os.scandir (тип берется из DirEntry, без stat)"""
+    files = []
+    directories = [root]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry.path)
+    return files
+
+# Пакеты меньше этого числа файлов распаковываются одним extractall: пул потоков не окупится
+_PARALLEL_EXTRACT_MIN_MEMBERS = 64
+_EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+
+def _member_parts(member: zipfile.ZipInfo) -> List[str]:
+    """Путь элемента архива по частям, как его запишет ZipFile.extract (те же правила очистки)"""
+    parts = os.path.splitdrive(member.filename.replace('/', os.sep))[1].split(os.sep)
+    return [part for part in parts if part not in ('', os.curdir, os.pardir)]
+
+def _member_dir(member: zipfile.ZipInfo, root: Path) -> Path:
+    """Папка, в которую ZipFile.extract запишет элемент"""
+    parts = _member_parts(member)
+    if not member.is_dir():
+        parts = parts[:-1]
+    return root.joinpath(*parts)
+
+def _find_manifest(root: Path, member_files: List[List[str]]) -> Optional[Path]:
+    """Манифест пакета по списку распакованных файлов: ближайший к корню imsmanifest.xml,
+    иначе ближайший файл с похожим именем (*manifest*.xml)"""
+    exact = [parts for parts in member_files if parts[-1] == 'imsmanifest.xml']
+    similar = [parts for parts in member_files if fnmatch.fnmatchcase(parts[-1], '*manifest*.xml')]
+    for found in (exact, similar):
+        if found:
+            return root.joinpath(*min(found, key=len))
+    return None
+
+def _is_macos_junk(member: zipfile.ZipInfo) -> bool:
+    """Служебные файлы архиваторов macOS: папка __MACOSX и .DS_Store"""
+    parts = _member_parts(member)
+    return not parts or parts[0] == '__MACOSX' or parts[-1] == '.DS_Store'
+
+def _extract_members(zip_ref: zipfile.ZipFile, members: List[zipfile.ZipInfo], root: Path) -> None:
+    """Распаковывает элементы архива параллельно. Папки создаются заранее в одном потоке,
+    чтобы потоки не создавали одну и ту же папку одновременно; zlib отпускает GIL при распаковке"""
+    if len(members) < _PARALLEL_EXTRACT_MIN_MEMBERS:
+        zip_ref.extractall(root, members)
+        return
+    
+    for directory in {_member_dir(member, root) for member in members}:
+        directory.mkdir(parents=True, exist_ok=True)
+    
+    files = [member for member in members if not member.is_dir()]
+    with ThreadPoolExecutor(max_workers=_EXTRACT_WORKERS) as executor:
+        # list() пробрасывает первое исключение из потоков
+        list(executor.map(lambda member: zip_ref.extract(member, root), files))
+
+def _release(elem) -> None:
+    """Освобождает разобранный элемент и уже пройденных соседей, чтобы дерево не росло"""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+def _parse_manifest_events(manifest_path: Path, encoding: Optional[str], recover: bool = False) -> Dict[str, Any]:
+    """Один потоковый проход по манифесту: метаданные, организации и ресурсы"""
+    # Внешние сущности не подставляются: манифест приходит из загруженного архива
+    context = LET.iterparse(
+        str(manifest_path),
+        events=('end',),
+        encoding=encoding,
+        recover=recover,
+        resolve_entities=False,
+        huge_tree=False
+    )
+    
+    title = description = None
+    organizations = []
+    resources = []
+    
+    for _, elem in context:
+        tag = elem.tag
+        if tag == _MD_TITLE_TAG:
+            if title is None:
+                title = elem.text or ''
+        elif tag == _MD_DESCRIPTION_TAG:
+            if description is None:
+                description = elem.text or ''
+        elif tag == _ORGANIZATION_TAG and elem.getparent().tag == _ORGANIZATIONS_TAG:
+            org_title = elem.find(_TITLE_TAG)
+            organizations.append({
+                'identifier': elem.get('identifier', ''),
+                'title': org_title.text.strip() if org_title is not None and org_title.text else ''
+            })
+            _release(elem)
+        elif tag == _RESOURCE_TAG and elem.getparent().tag == _RESOURCES_TAG:
+            resources.append({
+                'identifier': elem.get('identifier', ''),
+                'type': elem.get('type', ''),
+                'href': elem.get('href', ''),
+                'files': [file_elem.get('href') for file_elem in elem.iterchildren(_FILE_TAG) if file_elem.get('href')]
+            })
+            _release(elem)
+    
+    metadata = {'encoding_used': (encoding or context.root.getroottree().docinfo.encoding or 'utf-8').lower()}
+    if title:
+        metadata['title'] = title.strip()
+    if description:
+        metadata['description'] = description.strip()
+    metadata['organizations'] = organizations
+    metadata['resources'] = resources
+    return metadata
+
+# HTML в Markdown разбирается парсером lxml за один проход, дальше обходится готовое дерево
+_HTML_PARSER = LH.HTMLParser(encoding='utf-8', remove_comments=True, remove_pis=True)
+
+# Теги, содержимое которых не попадает в Markdown
+_SKIPPED_TAGS = ('script', 'style', 'head', 'noscript', 'template')
+
+# Типографские символы, которые в Markdown записываются ASCII-последовательностями (как &copy; -> (c))
+_TEXT_SYMBOLS = str.maketrans({
+    '\u00a9': '(c)',
+    '\u00ae': '(r)',
+    '\u2122': '(tm)',
+    '\u2026': '...',
+})
+
+# Обрамление содержимого тега: (префикс, суффикс)
+_MARKDOWN_WRAPS = {
+    'h1': ('# ', '\n\n'),
+    'h2': ('## ', '\n\n'),
+    'h3': ('### ', '\n\n'),
+    'h4': ('#### ', '\n\n'),
+    'h5': ('##### ', '\n\n'),
+    'h6': ('###### ', '\n\n'),
+    'b': ('**', '**'),
+    'strong': ('**', '**'),
+    'i': ('*', '*'),
+    'em': ('*', '*'),
+    'u': ('_', '_'),
+    'li': ('* ', '\n'),
+    'p': ('', '\n\n'),
+    'table': ('\n', '\n'),
+    'tr': ('\n', ''),
+    'td': ('| ', ' '),
+    'th': ('| **', '** '),
+}
+
+def _render_markdown(elem, out: List[str]) -> None:
+    """Дописывает в out Markdown элемента и его потомков (без хвостового текста)"""
+    tag = elem.tag
+    if not isinstance(tag, str) or tag in _SKIPPED_TAGS:
+        return
+    if tag == 'img':
+        out.append(f"![{elem.get('alt', '')}]({elem.get('src', '')})")
+        return
+    if tag == 'br':
+        out.append('  \n')
+        return
+    if tag == 'hr':
+        out.append('\n---\n')
+        return
+
+    href = elem.get('href') if tag == 'a' else None
+    prefix, suffix = _MARKDOWN_WRAPS.get(tag, ('', ''))
+    if href is not None:
+        prefix, suffix = '[', '](' + href + ')'
+    
+    out.append(prefix)
+    if elem.text:
+        out.append(elem.text.translate(_TEXT_SYMBOLS))
+    for child in elem:
+        _render_markdown(child, out)
+        if child.tail:
+            out.append(child.tail.translate(_TEXT_SYMBOLS))
+    out.append(suffix)
+
+def _html_to_markdown_text(html_content: str) -> str:
+    """Разбирает HTML и собирает Markdown обходом дерева; сущности декодирует парсер"""
+    if not html_content.strip():
+        return ''
+    try:
+        # Байты с явной кодировкой: lxml не принимает str с XML-декларацией кодировки
+        root = LH.document_fromstring(html_content.encode('utf-8'), parser=_HTML_PARSER)
+    except LET.ParserError:
+        # Документ без элементов (например, только комментарии)
+        return ''
+
+    out = []
+    _render_markdown(root, out)
+    return ''.join(out).replace('\xa0', ' ')
+
+_MARKDOWN_WHITESPACE_RULES = (
+    (re.compile(r'[ \t]+'), ' '),
+    (re.compile(r'\n[ \t]+\n'), '\n\n'),
+    (re.compile(r'\n\s*\n'), '\n\n'),
+)
+
+# Вердикты кодировок кэширует lru_cache, тексты файлов - LRU с ограничением суммарного размера в символах.
+# Файлы читаются из потоков, поэтому доступ к LRUCache под блокировкой
+_FILE_TEXT_CACHE_SIZE = 16 * 1024 * 1024
+_file_text_cache = LRUCache(maxsize=_FILE_TEXT_CACHE_SIZE, getsizeof=len)
+_file_text_lock = threading.Lock()
+
+# Буквы 'А'-'я': проверка кириллицы одним проходом isdisjoint на C вместо генератора по символам
+_CYRILLIC_LETTERS = frozenset(map(chr, range(ord('А'), ord('я') + 1)))
+
+# Объявление кодировки в HTML: <meta charset="...">, <meta content="text/html; charset=..."> или XML-декларация
+_DECLARED_CHARSET_RE = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)|<\?xml[^>]+encoding\s*=\s*["\']([\w.:-]+)',
+    re.IGNORECASE
+)
+
+def _declared_encoding(raw_data: bytes) -> Optional[str]:
+    """Объявленная в файле кодировка, если Python ее знает и начало файла в ней декодируется"""
+    match = _DECLARED_CHARSET_RE.search(raw_data)
+    if not match:
+        return None
+    try:
+        encoding = codecs.lookup((match.group(1) or match.group(2)).decode('ascii')).name
+        # Объявление прочитано как ASCII, значит UTF-16/32 и подобные ему противоречат
+        if '<meta'.encode(encoding) != b'<meta':
+            return None
+        # Неполный многобайтный символ в конце прочитанного куска не ошибка
+        codecs.getincrementaldecoder(encoding)().decode(raw_data, final=False)
+    except (LookupError, UnicodeError):
+        return None
+    return encoding
+
+@lru_cache(maxsize=1024)
+def _detect_encoding(file_path: str, mtime_ns: int, size: int) -> tuple:
+    """Определяет кодировку файла. mtime_ns и size входят в ключ кэша: измененный файл проверяется заново"""
+    # Список возможных кодировок для русских текстов
+    encodings = [
+        'utf-8', 'utf-8-sig',  # UTF-8 варианты
+        'cp1251', 'windows-1251',  # Windows кириллица
+        'koi8-r', 'koi8-u',  # KOI8
+        'iso-8859-1', 'iso-8859-5', 'iso-8859-15',  # ISO
+        'cp866', 'ibm866',  # DOS/OEM кириллица
+        'maccyrillic',  # Mac кириллица
+        'latin-1',  # Западноевропейская
+    ]
+    
+    # Сначала читаем первые несколько байт для анализа
+    try:
+        with open(file_path, 'rb') as f:
+            raw_data = f.read(4096)  # Читаем первые 4KB
+        
+        # Проверяем BOM для UTF-8
+        if raw_data.startswith(b'\xef\xbb\xbf'):
+            return 'utf-8-sig', "BOM detected"
+        
+        # Кодировка из <meta charset> или XML-декларации: перебор не нужен
+        declared = _declared_encoding(raw_data)
+        if declared:
+            return declared, "Declared"
+        
+        # Простая эвристика для определения кодировки
+        for encoding in encodings:
+            try:
+                # Пробуем декодировать
+                test_data = raw_data[:1000]  # Тестируем на первых 1000 байтах
+                decoded = test_data.decode(encoding)
+                
+                # Проверяем наличие кириллицы (опционально)
+                if not _CYRILLIC_LETTERS.isdisjoint(decoded):
+                    return encoding, "Cyrillic detected"
+                
+                return encoding, "Success"
+            except UnicodeDecodeError:
+                continue
+        
+        return 'utf-8', "Fallback"
+    
+    except Exception as e:
+        logger.warning(f"Не удалось определить кодировку для {file_path}: {e}")
+        return 'utf-8', f"Error: {e}"
+
+# Ссылки на изображения в HTML: тег img с атрибутом src (группы 1, 2) или CSS background-image (группа 4)
+_IMAGE_REFERENCE_RE = re.compile(
+    r'(<img[^>]*src=["\']([^"\']+)["\'][^>]*>)'
+    r'|(?i:(background-image:\s*url\(["\']?([^)"\']+)["\']?\)))'
+)
+_IMG_SRC_ATTR_RE = re.compile(r'src=["\'][^"\']+["\']')
+
+def _file_content_hash(path: Path) -> Tuple[str, int]:
+    """BLAKE2b содержимого файла (16 hex-символов) и размер файла, посчитанный при чтении"""
+    digest = hashlib.blake2b(digest_size=8)
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+# Последний сохраненный файл для каждого хэша содержимого: то же изображение из другого урока
+# или пакета связывается с ним жесткой ссылкой вместо копирования
+_stored_images = LRUCache(maxsize=4096)
+_stored_images_lock = threading.Lock()
+
+def _store_image(src: Path, dst: Path, content_hash: str) -> None:
+    """Сохраняет изображение урока: жесткая ссылка на уже сохраненную копию или копирование"""
+    with _stored_images_lock:
+        stored = _stored_images.get(content_hash)
+    if stored is not None and stored != dst:
+        try:
+            os.link(stored, dst)
+            return
+        except FileExistsError:
+            # Имя содержит хэш содержимого, значит файл уже тот же
+            return
+        except OSError:
+            # Копию удалили, другая файловая система или нет поддержки жестких ссылок
+            pass
+    
+    # copyfile без метаданных (на Linux через sendfile), в отличие от copy2
+    shutil.copyfile(src, dst)
+    with _stored_images_lock:
+        _stored_images[content_hash] = dst
+
+@lru_cache(maxsize=4)
+def _package_file_index(extracted_path: str, root_ino: int, root_mtime_ns: int) -> frozenset:
+    """Нормализованные пути всех файлов распакованного пакета: один обход на пакет в процессе.
+    Inode и mtime корня входят в ключ, чтобы пересозданная папка не брала старый индекс"""
+    return frozenset(os.path.normpath(path) for path in _walk_files(extracted_path))
+
+def _get_package_file_index(extracted_path: str) -> frozenset:
+    root_stat = os.stat(extracted_path)
+    return _package_file_index(str(extracted_path), root_stat.st_ino, root_stat.st_mtime_ns)
+
+def _find_image_file(possible_paths: List[Path], package_files: frozenset) -> Optional[Path]:
+    """Первый из кандидатов, который есть среди файлов пакета (поиск в множестве, без stat)"""
+    for path in possible_paths:
+        if os.path.normpath(path) in package_files:
+            return path
+    return None
+
 class SCORMParser:
     def __init__(self, upload_dir: str = "./uploads/scorm"):
         self.upload_dir = Path(upload_dir)
@@ -20,93 +431,18 @@ class SCORMParser:
     def parse_manifest(self, manifest_path: Path) -> Dict[str, Any]:
         """Парсит файл imsmanifest.xml"""
         try:
-            # Пробуем разные кодировки для чтения XML
-            encodings = ['utf-8', 'utf-8-sig', 'cp1251', 'windows-1251', 
-                        'iso-8859-1', 'latin-1', 'koi8-r', 'cp866', 'maccyrillic']
-            
-            root = None
-            used_encoding = 'utf-8'
-            
-            for encoding in encodings:
-                try:
-                    with open(manifest_path, 'r', encoding=encoding) as f:
-                        content = f.read()
-                    
-                    # Парсим XML
-                    root = ET.fromstring(content)
-                    used_encoding = encoding
-                    logger.info(f"Manifest прочитан в кодировке: {encoding}")
-                    break
-                except (UnicodeDecodeError, ET.ParseError) as e:
-                    logger.debug(f"Не удалось прочитать манифест в кодировке {encoding}: {e}")
-                    continue
-            
-            if root is None:
-                # Если ни одна кодировка не подошла, читаем как бинарный и игнорируем ошибки
-                with open(manifest_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                root = ET.fromstring(content)
-                used_encoding = 'utf-8 (ignore errors)'
-            
-            # Namespace для SCORM
-            ns = {
-                'imscp': 'http://www.imsglobal.org/xsd/imscp_v1p1',
-                'adlcp': 'http://www.adlnet.org/xsd/adlcp_v1p3',
-                'imsmd': 'http://www.imsglobal.org/xsd/imsmd_v1p2'
-            }
-            
-            # Извлекаем метаданные
-            metadata = {
-                'encoding_used': used_encoding,
-                'manifest_path': str(manifest_path)
-            }
-            
-            # Заголовок
-            title_elem = root.find('.//imsmd:title', ns)
-            if title_elem is not None and title_elem.text:
-                metadata['title'] = title_elem.text.strip()
-            
-            # Описание
-            description_elem = root.find('.//imsmd:description', ns)
-            if description_elem is not None and description_elem.text:
-                metadata['description'] = description_elem.text.strip()
-            
-            # Организация
-            organizations = []
-            for org_elem in root.findall('.//imscp:organizations/imscp:organization', ns):
-                org_data = {
-                    'identifier': org_elem.get('identifier', ''),
-                    'title': ''
-                }
-                
-                title_elem = org_elem.find('imscp:title', ns)
-                if title_elem is not None and title_elem.text:
-                    org_data['title'] = title_elem.text.strip()
-                
-                organizations.append(org_data)
-            
-            metadata['organizations'] = organizations
-            
-            # Ресурсы
-            resources = []
-            for resource_elem in root.findall('.//imscp:resources/imscp:resource', ns):
-                resource = {
-                    'identifier': resource_elem.get('identifier', ''),
-                    'type': resource_elem.get('type', ''),
-                    'href': resource_elem.get('href', ''),
-                    'files': []
-                }
-                
-                # Файлы ресурса
-                for file_elem in resource_elem.findall('imscp:file', ns):
-                    file_href = file_elem.get('href')
-                    if file_href:
-                        resource['files'].append(file_href)
-                
-                resources.append(resource)
-            
-            metadata['resources'] = resources
-            
+            # Кодировка подбирается по байтам, XML разбирается один раз
+            encoding = _manifest_encoding(manifest_path)
+            try:
+                metadata = _parse_manifest_events(manifest_path, encoding)
+                logger.info(f"Manifest прочитан в кодировке: {metadata['encoding_used']}")
+            except (LET.XMLSyntaxError, UnicodeDecodeError) as e:
+                # Битый XML разбираем с восстановлением после ошибок
+                logger.debug(f"Не удалось прочитать манифест в кодировке {encoding or 'из декларации'}: {e}")
+                metadata = _parse_manifest_events(manifest_path, encoding, recover=True)
+                metadata['encoding_used'] += ' (recover)'
+            
+            metadata['manifest_path'] = str(manifest_path)
             return metadata
             
         except Exception as e:
@@ -117,108 +453,61 @@ class SCORMParser:
         """Извлекает SCORM пакет и парсит его"""
         extract_path = Path(extract_to)
         
-        # Очищаем папку для извлечения
-        if extract_path.exists():
-            shutil.rmtree(extract_path)
-        extract_path.mkdir(parents=True)
+        # Папка для извлечения обычно новая. Старую переименовываем и удаляем в фоне,
+        # чтобы распаковка не ждала удаления тысяч файлов
+        try:
+            extract_path.mkdir(parents=True)
+        except FileExistsError:
+            stale_path = extract_path.with_name(f"{extract_path.name}.old.{os.urandom(4).hex()}")
+            extract_path.rename(stale_path)
+            threading.Thread(target=shutil.rmtree, args=(stale_path, True), daemon=True).start()
+            extract_path.mkdir()
         
         try:
             logger.info(f"Извлечение SCORM пакета в {extract_path}")
             
             # Извлекаем ZIP
             with zipfile.ZipFile(scorm_file, 'r') as zip_ref:
-                zip_ref.extractall(extract_path)
-
-            if (extract_path / "__MACOSX").exists():
-                shutil.rmtree(extract_path / "__MACOSX")
-
-            # Ищем манифест
-            manifest_path = extract_path / "imsmanifest.xml"
-            if not manifest_path.exists():
-                # Пробуем найти в подпапках
-                found = False
-                for file in extract_path.rglob("imsmanifest.xml"):
-                    manifest_path = file
-                    found = True
-                    logger.info(f"Найден манифест: {manifest_path}")
-                    break
-                
-                if not found:
-                    # Попробуем найти файлы с похожими именами
-                    for file in extract_path.rglob("*manifest*.xml"):
-                        manifest_path = file
-                        found = True
-                        logger.info(f"Найден альтернативный манифест: {manifest_path}")
-                        break
-
-            if not manifest_path.exists():
+                # Служебные файлы macOS не распаковываются вовсе
+                members = [member for member in zip_ref.infolist() if not _is_macos_junk(member)]
+                _extract_members(zip_ref, members, extract_path)
+            member_files = [_member_parts(member) for member in members if not member.is_dir()]
+
+            # Ищем манифест среди записанных файлов, без обхода дерева
+            manifest_path = _find_manifest(extract_path, member_files)
+            if manifest_path is None:
                 raise Exception("Файл imsmanifest.xml не найден в пакете")
+            logger.info(f"Найден манифест: {manifest_path}")
             
             # Парсим манифест
             metadata = self.parse_manifest(manifest_path)
             
-            # Ищем HTML/файлы для конвертации
-            html_files = []
-            image_files = []
-            other_files = []
+            # Все файлы пакета одним обходом, без повторных rglob по каждому расширению
+            package_files = _walk_files(str(extract_path))
+            existing_files = set(package_files)
+            
+            collected = {'html': [], 'image': [], 'other': []}
+            seen = set()
             
-            # Собираем все файлы из ресурсов
+            # Сначала файлы из ресурсов манифеста (в его порядке)
             for resource in metadata.get('resources', []):
                 for file in resource.get('files', []):
                     if file:
-                        full_path = extract_path / file
-                        if full_path.exists():
-                            # Классифицируем файлы
-                            file_str = str(full_path)
-                            file_lower = file.lower()
-                            
-                            if file_lower.endswith(('.html', '.htm')):
-                                html_files.append(file_str)
-                            elif file_lower.endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp')):
-                                image_files.append(file_str)
-                            else:
-                                other_files.append(file_str)
-            
-            # Также ищем файлы в извлеченной папке
-            for html_file in extract_path.rglob("*.html"):
-                file_str = str(html_file)
-                if file_str not in html_files:
-                    html_files.append(file_str)
-            
-            for html_file in extract_path.rglob("*.htm"):
-                file_str = str(html_file)
-                if file_str not in html_files:
-                    html_files.append(file_str)
-            
-            for img_file in extract_path.rglob("*.jpg"):
-                file_str = str(img_file)
-                if file_str not in image_files:
-                    image_files.append(file_str)
-            
-            for img_file in extract_path.rglob("*.jpeg"):
-                file_str = str(img_file)
-                if file_str not in image_files:
-                    image_files.append(file_str)
-            
-            for img_file in extract_path.rglob("*.png"):
-                file_str = str(img_file)
-                if file_str not in image_files:
-                    image_files.append(file_str)
-            
-            for img_file in extract_path.rglob("*.gif"):
-                file_str = str(img_file)
-                if file_str not in image_files:
-                    image_files.append(file_str)
-            
-            for img_file in extract_path.rglob("*.bmp"):
-                file_str = str(img_file)
-                if file_str not in image_files:
-                    image_files.append(file_str)
-            
-            for img_file in extract_path.rglob("*.svg"):
-                file_str = str(img_file)
-                if file_str not in image_files:
-                    image_files.append(file_str)
+                        file_str = str(extract_path / file)
+                        if file_str in existing_files and file_str not in seen:
+                            seen.add(file_str)
+                            collected[_file_kind(file)].append(file_str)
+            
+            # Также HTML и изображения, не указанные в манифесте
+            for file_str in package_files:
+                kind = _file_kind(file_str)
+                if kind != 'other' and file_str not in seen:
+                    seen.add(file_str)
+                    collected[kind].append(file_str)
+            
+            html_files = collected['html']
+            image_files = collected['image']
+            other_files = collected['other']
             
             metadata['extracted_path'] = str(extract_path)
             metadata['html_files'] = html_files
@@ -243,56 +532,38 @@ class SCORMParser:
             raise Exception(f"Ошибка при обработке SCORM пакета: {str(e)}")
     
     def detect_file_encoding(self, file_path: str) -> tuple:
-        """Определяет кодировку файла"""
-        # Список возможных кодировок для русских текстов
-        encodings = [
-            'utf-8', 'utf-8-sig',  # UTF-8 варианты
-            'cp1251', 'windows-1251',  # Windows кириллица
-            'koi8-r', 'koi8-u',  # KOI8
-            'iso-8859-1', 'iso-8859-5', 'iso-8859-15',  # ISO
-            'cp866', 'ibm866',  # DOS/OEM кириллица
-            'maccyrillic',  # Mac кириллица
-            'latin-1',  # Западноевропейская
-        ]
-        
-        # Сначала читаем первые несколько байт для анализа
+        """Определяет кодировку файла (вердикт кэшируется по пути, mtime и размеру)"""
         try:
-            with open(file_path, 'rb') as f:
-                raw_data = f.read(4096)  # Читаем первые 4KB
-            
-            # Проверяем BOM для UTF-8
-            if raw_data.startswith(b'\xef\xbb\xbf'):
-                return 'utf-8-sig', "BOM detected"
-            
-            # Простая эвристика для определения кодировки
-            for encoding in encodings:
-                try:
-                    # Пробуем декодировать
-                    test_data = raw_data[:1000]  # Тестируем на первых 1000 байтах
-                    decoded = test_data.decode(encoding)
-                    
-                    # Проверяем наличие кириллицы (опционально)
-                    if any(ord('А') <= ord(c) <= ord('я') for c in decoded if c.isalpha()):
-                        return encoding, "Cyrillic detected"
-                    
-                    return encoding, "Success"
-                except UnicodeDecodeError:
-                    continue
-            
-            return 'utf-8', "Fallback"
-            
-        except Exception as e:
+            file_stat = os.stat(file_path)
+        except OSError as e:
             logger.warning(f"Не удалось определить кодировку для {file_path}: {e}")
             return 'utf-8', f"Error: {e}"
+        return _detect_encoding(str(file_path), file_stat.st_mtime_ns, file_stat.st_size)
     
     def read_file_with_encoding(self, file_path: str) -> str:
+        """Читает файл с правильной кодировкой; текст неизменившегося файла берется из кэша"""
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return self._read_file_with_encoding(file_path)
+        
+        cache_key = (str(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+        with _file_text_lock:
+            content = _file_text_cache.get(cache_key)
+        if content is None:
+            content = self._read_file_with_encoding(file_path)
+            if len(content) <= _file_text_cache.maxsize:
+                with _file_text_lock:
+                    _file_text_cache[cache_key] = content
+        return content
+    
+    def _read_file_with_encoding(self, file_path: str) -> str:
         """Читает файл с правильной кодировкой"""
         encoding, reason = self.detect_file_encoding(file_path)
         logger.info(f"Чтение файла {file_path} в кодировке {encoding} ({reason})")
         
         try:
-            with open(file_path, 'r', encoding=encoding, errors='replace') as f:
-                content = f.read()
+            content = _read_text(file_path, encoding, 'replace')
             
             # Удаляем BOM если есть
             if content.startswith('\ufeff'):
@@ -311,8 +582,7 @@ class SCORMParser:
                     continue
                     
                 try:
-                    with open(file_path, 'r', encoding=enc, errors='replace') as f:
-                        content = f.read()
+                    content = _read_text(file_path, enc, 'replace')
                     
                     if content.startswith('\ufeff'):
                         content = content[1:]
@@ -324,8 +594,7 @@ class SCORMParser:
             
             # Если ничего не помогло, читаем с игнорированием ошибок
             try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
+                content = _read_text(file_path, 'utf-8', 'ignore')
                 
                 logger.warning(f"Файл прочитан с игнорированием ошибок")
                 return content
@@ -344,156 +613,98 @@ class SCORMParser:
         # Папка для сохранения изображений этого урока
         images_dir = Path(upload_base_dir) / "courses" / str(course_id) / "lessons" / str(lesson_id) / "images"
         images_dir.mkdir(parents=True, exist_ok=True)
+        images_url = f"/uploads/courses/{course_id}/lessons/{lesson_id}/images"
         
-        # Регулярное выражение для поиска изображений в HTML
-        # Ищем теги img с src атрибутом
-        img_pattern = r'<img[^>]*src=["\']([^"\']+)["\'][^>]*>'
+        html_dir = Path(html_file_path).parent
+        extract_root = Path(extracted_path)
+        package_files = _get_package_file_index(extracted_path)
         
-        def replace_image(match):
-            img_tag = match.group(0)
-            img_src = match.group(1)
-            
-            # Пропускаем data:image (встроенные изображения) и внешние URL
-            if img_src.startswith('data:') or img_src.startswith(('http://', 'https://', '//')):
-                return img_tag
-            
-            # Определяем полный путь к изображению
-            img_path = None
-            
-            # Пробуем несколько вариантов:
-            # 1. Относительный путь от HTML файла
-            html_dir = Path(html_file_path).parent
+        # Новый URL по (ссылке, фон ли это); None - изображение не найдено или не скопировано
+        resolved_urls = {}
+        # Имена уже скопированных файлов: повторная ссылка на ту же картинку не копирует ее заново
+        # и не создает второе вложение
+        copied_files = set()
+        
+        def copy_image(src: str, background: bool) -> Optional[str]:
+            # Определяем полный путь к изображению: относительно HTML файла
+            # или от корня SCORM, как есть и URL decoded
             possible_paths = [
-                html_dir / img_src,  # Относительный путь
-                html_dir / unquote(img_src),  # URL decoded
-                Path(extracted_path) / img_src.lstrip('/'),  # Абсолютный от корня SCORM
-                Path(extracted_path) / unquote(img_src.lstrip('/')),  # URL decoded
+                html_dir / src,
+                html_dir / unquote(src),
+                extract_root / src.lstrip('/'),
+                extract_root / unquote(src.lstrip('/')),
             ]
             
-            for path in possible_paths:
-                if path.exists() and path.is_file():
-                    img_path = path
-                    break
+            img_path = _find_image_file(possible_paths, package_files)
             
             if not img_path:
-                logger.warning(f"Изображение не найдено: {img_src} в файле {html_file_path}")
-                return img_tag
+                if not background:
+                    logger.warning(f"Изображение не найдено: {src} в файле {html_file_path}")
+                return None
             
-            # Генерируем уникальное имя для изображения
-            file_hash = hashlib.md5(str(img_path).encode()).hexdigest()[:8]
-            original_name = img_path.name
-            name_without_ext = img_path.stem
+            # Имя по хэшу содержимого: одинаковые изображения получают одинаковое имя
+            try:
+                file_hash, img_size = _file_content_hash(img_path)
+            except OSError as e:
+                logger.error(f"Ошибка при чтении изображения {img_path}: {e}")
+                return None
             extension = img_path.suffix.lower()
             
             # Если расширение не стандартное, используем .bin
-            if extension not in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp']:
+            if extension[1:] not in _IMAGE_EXTENSIONS:
                 extension = '.bin'
             
-            new_filename = f"{name_without_ext}_{file_hash}{extension}"
+            new_filename = f"{img_path.stem}_{'bg_' if background else ''}{file_hash}{extension}"
             new_filepath = images_dir / new_filename
+            new_url = f"{images_url}/{new_filename}"
+            if new_filename in copied_files:
+                return new_url
             
-            # Копируем изображение
             try:
-                shutil.copy2(img_path, new_filepath)
-                logger.info(f"Скопировано изображение: {img_path} -> {new_filepath}")
-                
-                # Формируем новый URL для изображения
-                new_url = f"/uploads/courses/{course_id}/lessons/{lesson_id}/images/{new_filename}"
-                
-                # Заменяем src в теге img
-                new_img_tag = re.sub(
-                    r'src=["\'][^"\']+["\']',
-                    f'src="{new_url}"',
-                    img_tag
-                )
-                
-                # Добавляем информацию о изображении
-                processed_images.append({
-                    'original_path': str(img_path),
-                    'original_src': img_src,
-                    'new_path': str(new_filepath),
-                    'new_url': new_url,
-                    'filename': new_filename
-                })
-                
-                return new_img_tag
-                
+                _store_image(img_path, new_filepath, file_hash)
             except Exception as e:
                 logger.error(f"Ошибка при копировании изображения {img_path}: {e}")
-                return img_tag
-        
-        # Заменяем все изображения в HTML
-        updated_html = re.sub(img_pattern, replace_image, html_content)
-        
-        # Также обрабатываем CSS background-image
-        bg_pattern = r'background-image:\s*url\(["\']?([^)"\']+)["\']?\)'
-        
-        def replace_background(match):
-            bg_url = match.group(1)
-            full_match = match.group(0)
-            
-            # Пропускаем внешние URL и data:image
-            if bg_url.startswith('data:') or bg_url.startswith(('http://', 'https://', '//')):
-                return full_match
-            
-            # Определяем путь к изображению
-            img_path = None
-            html_dir = Path(html_file_path).parent
-            possible_paths = [
-                html_dir / bg_url,
-                html_dir / unquote(bg_url),
-                Path(extracted_path) / bg_url.lstrip('/'),
-                Path(extracted_path) / unquote(bg_url.lstrip('/')),
-            ]
-            
-            for path in possible_paths:
-                if path.exists() and path.is_file():
-                    img_path = path
-                    break
-            
-            if not img_path:
-                return full_match
-            
-            # Генерируем уникальное имя
-            file_hash = hashlib.md5(str(img_path).encode()).hexdigest()[:8]
-            original_name = img_path.name
-            name_without_ext = img_path.stem
-            extension = img_path.suffix.lower()
-            
-            if extension not in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp']:
-                extension = '.bin'
-            
-            new_filename = f"{name_without_ext}_bg_{file_hash}{extension}"
-            new_filepath = images_dir / new_filename
-            
-            # Копируем изображение
-            try:
-                shutil.copy2(img_path, new_filepath)
-                logger.info(f"Скопировано фоновое изображение: {img_path} -> {new_filepath}")
-                
-                # Формируем новый URL
-                new_url = f"/uploads/courses/{course_id}/lessons/{lesson_id}/images/{new_filename}"
-                
-                # Заменяем URL
-                new_bg = f'background-image: url("{new_url}")'
+                return None
+            copied_files.add(new_filename)
+            logger.info(f"Скопировано изображение: {img_path} -> {new_filepath}")
                 
-                processed_images.append({
-                    'original_path': str(img_path),
-                    'original_src': bg_url,
-                    'new_path': str(new_filepath),
-                    'new_url': new_url,
-                    'filename': new_filename,
-                    'type': 'background'
-                })
+            # Добавляем информацию о изображении
+            image_info = {
+                'original_path': str(img_path),
+                'original_src': src,
+                'new_path': str(new_filepath),
+                'new_url': new_url,
+                'filename': new_filename,
+                'size': img_size
+            }
+            if background:
+                image_info['type'] = 'background'
+            processed_images.append(image_info)
+            return new_url
                 
-                return new_bg
+        def replace_image(match):
+            img_tag = match.group(1)
+            background = img_tag is None
+            src = match.group(4) if background else match.group(2)
                 
-            except Exception as e:
-                logger.error(f"Ошибка при копировании фонового изображения {img_path}: {e}")
-                return full_match
+            # Пропускаем data:image (встроенные изображения) и внешние URL
+            if src.startswith(('data:', 'http://', 'https://', '//')):
+                return match.group(0)
         
-        # Заменяем background-image
-        updated_html = re.sub(bg_pattern, replace_background, updated_html, flags=re.IGNORECASE)
+            key = (src, background)
+            if key not in resolved_urls:
+                resolved_urls[key] = copy_image(src, background)
+            new_url = resolved_urls[key]
+            if new_url is None:
+                return match.group(0)
+        
+            if background:
+                return f'background-image: url("{new_url}")'
+            # Заменяем src в теге img
+            return _IMG_SRC_ATTR_RE.sub(f'src="{new_url}"', img_tag)
+        
+        # Теги img и CSS background-image заменяются за один проход
+        updated_html = _IMAGE_REFERENCE_RE.sub(replace_image, html_content)
         
         return updated_html, processed_images
     
@@ -531,134 +742,29 @@ class SCORMParser:
             logger.error(f"Ошибка при конвертации HTML в Markdown с изображениями: {str(e)}")
             raise
     
+    def convert_lessons(self, items: List[Tuple[str, int]], extracted_path: str,
+                        upload_base_dir: str, course_id: int) -> List[Any]:
+        """
+        Конвертирует пачку HTML файлов (путь, id урока) в одном процессе.
+        Для каждого файла возвращает (Markdown, изображения) или исключение.
+        """
+        results = []
+        for html_file_path, lesson_id in items:
+            try:
+                results.append(self.convert_to_markdown_with_images(
+                    html_file_path, extracted_path, upload_base_dir, course_id, lesson_id
+                ))
+            except Exception as e:
+                results.append(e)
+        return results
+    
     def _html_to_markdown(self, html_content: str) -> str:
         """Конвертирует HTML в Markdown"""
-        # Упрощённая конвертация HTML в Markdown
-        # Удаляем теги script и style
-        html_content = re.sub(r'<script\b[^<]*(?:(?!<\/script>)<[^<]*)*<\/script>', '', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        html_content = re.sub(r'<style\b[^<]*(?:(?!<\/style>)<[^<]*)*<\/style>', '', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        
-        # Заменяем заголовки
-        for i in range(6, 0, -1):
-            tag = f'h{i}'
-            html_content = re.sub(
-                f'<{tag}[^>]*>(.*?)</{tag}>',
-                f'{"#" * i} \\1\n\n',
-                html_content,
-                flags=re.IGNORECASE | re.DOTALL
-            )
-        
-        # Заменяем жирный текст
-        html_content = re.sub(r'<b\b[^>]*>(.*?)</b>', r'**\1**', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        html_content = re.sub(r'<strong\b[^>]*>(.*?)</strong>', r'**\1**', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        
-        # Заменяем курсив
-        html_content = re.sub(r'<i\b[^>]*>(.*?)</i>', r'*\1*', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        html_content = re.sub(r'<em\b[^>]*>(.*?)</em>', r'*\1*', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        
-        # Заменяем подчеркнутый текст
-        html_content = re.sub(r'<u\b[^>]*>(.*?)</u>', r'_\1_', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        
-        # Заменяем ссылки
-        html_content = re.sub(
-            r'<a\b[^>]*href="([^"]*)"[^>]*>(.*?)</a>',
-            r'[\2](\1)',
-            html_content,
-            flags=re.IGNORECASE | re.DOTALL
-        )
-        
-        # Заменяем изображения (уже обработаны, но на всякий случай оставляем)
-        html_content = re.sub(
-            r'<img\b[^>]*src="([^"]*)"[^>]*alt="([^"]*)"[^>]*>',
-            r'![\2](\1)',
-            html_content,
-            flags=re.IGNORECASE
-        )
-        html_content = re.sub(
-            r'<img\b[^>]*src="([^"]*)"[^>]*>',
-            r'![](\1)',
-            html_content,
-            flags=re.IGNORECASE
-        )
-        
-        # Заменяем списки
-        html_content = re.sub(r'<li\b[^>]*>(.*?)</li>', r'* \1\n', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        html_content = re.sub(r'<ul\b[^>]*>|</ul>', r'', html_content, flags=re.IGNORECASE)
-        html_content = re.sub(r'<ol\b[^>]*>|</ol>', r'', html_content, flags=re.IGNORECASE)
-        
-        # Заменяем параграфы
-        html_content = re.sub(r'<p\b[^>]*>(.*?)</p>', r'\1\n\n', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        
-        # Заменяем переносы строк
-        html_content = re.sub(r'<br\b[^>]*>', r'  \n', html_content, flags=re.IGNORECASE)
-        
-        # Заменяем горизонтальные линии
-        html_content = re.sub(r'<hr\b[^>]*>', r'\n---\n', html_content, flags=re.IGNORECASE)
-        
-        # Обработка таблиц (упрощенная)
-        html_content = re.sub(r'<table[^>]*>', r'\n', html_content, flags=re.IGNORECASE)
-        html_content = re.sub(r'</table>', r'\n', html_content, flags=re.IGNORECASE)
-        html_content = re.sub(r'<tr[^>]*>', r'\n', html_content, flags=re.IGNORECASE)
-        html_content = re.sub(r'</tr>', r'', html_content, flags=re.IGNORECASE)
-        html_content = re.sub(r'<td[^>]*>(.*?)</td>', r'| \1 ', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        html_content = re.sub(r'<th[^>]*>(.*?)</th>', r'| **\1** ', 
-                             html_content, flags=re.IGNORECASE | re.DOTALL)
-        
-        # Удаляем оставшиеся теги
-        html_content = re.sub(r'<[^>]*>', '', html_content)
-        
-        # Заменяем HTML entities
-        html_entities = {
-            '&nbsp;': ' ',
-            '&lt;': '<',
-            '&gt;': '>',
-            '&amp;': '&',
-            '&quot;': '"',
-            '&#39;': "'",
-            '&apos;': "'",
-            '&copy;': '(c)',
-            '&reg;': '(r)',
-            '&trade;': '(tm)',
-            '&mdash;': '—',
-            '&ndash;': '–',
-            '&hellip;': '...',
-            '&laquo;': '«',
-            '&raquo;': '»',
-        }
-        
-        for entity, replacement in html_entities.items():
-            html_content = html_content.replace(entity, replacement)
-        
-        # Заменяем числовые HTML entities
-        def replace_decimal_entity(match):
-            try:
-                return chr(int(match.group(1)))
-            except:
-                return match.group(0)
-        
-        def replace_hex_entity(match):
-            try:
-                return chr(int(match.group(1), 16))
-            except:
-                return match.group(0)
-        
-        html_content = re.sub(r'&#(\d+);', replace_decimal_entity, html_content)
-        html_content = re.sub(r'&#x([0-9a-fA-F]+);', replace_hex_entity, html_content)
+        html_content = _html_to_markdown_text(html_content)
         
         # Очищаем лишние пробелы и переносы строк
-        html_content = re.sub(r'[ \t]+', ' ', html_content)
-        html_content = re.sub(r'\n[ \t]+\n', '\n\n', html_content)
-        html_content = re.sub(r'\n\s*\n', '\n\n', html_content)
+        for pattern, replacement in _MARKDOWN_WHITESPACE_RULES:
+            html_content = pattern.sub(replacement, html_content)
         
         # Удаляем пустые строки в начале и конце
         html_content = html_content.strip()
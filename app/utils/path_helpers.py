@@ -1,32 +1,45 @@
 import os
-from pathlib import Path
+import stat
+from functools import lru_cache
 from typing import Optional
 from app.config import settings
 
+# Абсолютный путь UPLOAD_DIR считается один раз при импорте, а не в каждом вызове (getcwd).
+# Частые помощники работают со строками os.path, без создания объектов pathlib
+_UPLOAD_DIR_ABS = os.path.abspath(settings.UPLOAD_DIR)
+_UPLOAD_DIR_PREFIX = _UPLOAD_DIR_ABS + os.sep
+_UPLOAD_DIR_PREFIX_LEN = len(_UPLOAD_DIR_PREFIX)
+# Префикс URL загруженных файлов
+_UPLOADS_URL_PREFIX = '/uploads/'
+# На POSIX путь уже в формате URL, замена разделителей нужна только на Windows
+_NATIVE_SEP_IS_SLASH = os.sep == '/'
+
+@lru_cache(maxsize=4096)
 def get_file_url(file_path: str) -> str:
     """
-    Преобразует локальный путь в URL для доступа через /uploads
+    Преобразует локальный путь в URL для доступа через /uploads.
+    Результат зависит только от пути (UPLOAD_DIR и рабочий каталог не меняются), поэтому кэшируется
     """
     if not file_path:
         return ""
     
-    # Если это уже URL, возвращаем как есть
-    if file_path.startswith(('http://', 'https://', '//')):
+    # Если это уже URL, возвращаем как есть. Пути в UPLOAD_DIR (./uploads/...) отсекаются
+    # по первому символу без сравнения с каждым префиксом
+    if file_path[0] in 'h/' and file_path.startswith(('http://', 'https://', '//')):
         return file_path
     
-    # Если путь абсолютный и находится внутри UPLOAD_DIR
-    abs_path = Path(file_path).absolute()
-    upload_dir = Path(settings.UPLOAD_DIR).absolute()
+    # Если путь находится внутри UPLOAD_DIR - сравнение префикса строки, без pathlib и исключений
+    abs_path = os.path.abspath(file_path)
+    if abs_path.startswith(_UPLOAD_DIR_PREFIX):
+        rel_path = abs_path[_UPLOAD_DIR_PREFIX_LEN:]
+        if not _NATIVE_SEP_IS_SLASH:
+            rel_path = rel_path.replace(os.sep, '/')
+        return _UPLOADS_URL_PREFIX + rel_path
     
-    try:
-        # Пробуем получить относительный путь
-        rel_path = abs_path.relative_to(upload_dir)
-        return f"/uploads/{rel_path.as_posix()}"
-    except ValueError:
-        # Если путь не внутри UPLOAD_DIR, возвращаем как есть
-        return file_path
+    # Если путь не внутри UPLOAD_DIR, возвращаем как есть
+    return file_path
 
-def get_absolute_path(file_url: str) -> Optional[Path]:
+def get_absolute_path(file_url: str) -> Optional[str]:
     """
     Преобразует URL вида /uploads/... в абсолютный путь к файлу
     """
@@ -34,34 +47,48 @@ def get_absolute_path(file_url: str) -> Optional[Path]:
         return None
     
     # Если это не uploads URL, возвращаем None
-    if not file_url.startswith('/uploads/'):
+    if not file_url.startswith(_UPLOADS_URL_PREFIX):
         return None
     
     # Убираем /uploads/ и добавляем к базовому пути
-    rel_path = file_url[9:]  # Убираем '/uploads/'
-    abs_path = Path(settings.UPLOAD_DIR) / rel_path
-    
-    return abs_path.absolute()
+    rel_path = file_url[len(_UPLOADS_URL_PREFIX):]
+    return os.path.abspath(os.path.join(_UPLOAD_DIR_ABS, rel_path))
 
 def ensure_directory_exists(file_path: str) -> bool:
     """
     Создает директорию для файла, если она не существует
     """
+    directory = os.path.dirname(file_path)
+    if not directory:
+        # Файл в текущем каталоге
+        return True
     try:
-        path = Path(file_path)
-        path.parent.mkdir(parents=True, exist_ok=True)
+        os.makedirs(directory, exist_ok=True)
         return True
-    except Exception:
+    except OSError:
         return False
 
+@lru_cache(maxsize=32)
+def _real_base_path(base_path: str) -> str:
+    """Базовые каталоги постоянны, поэтому realpath (lstat каждого компонента) выполняется один раз"""
+    return os.path.realpath(base_path)
+
 def is_safe_path(base_path: str, target_path: str) -> bool:
     """
     Проверяет, что target_path находится внутри base_path
     (защита от path traversal)
     """
     try:
-        base = Path(base_path).resolve()
-        target = Path(target_path).resolve()
-        return base in target.parents or base == target
+        # Сама цель-симлинк отклоняется до канонизации: realpath увел бы проверку по ссылке
+        try:
+            if stat.S_ISLNK(os.lstat(target_path).st_mode):
+                return False
+        except FileNotFoundError:
+            # Файла еще нет (проверка пути перед записью)
+            pass
+        
+        base = _real_base_path(base_path)
+        target = os.path.realpath(target_path)
+        return target == base or target.startswith(base + os.sep)
     except Exception:
         return False
\ No newline at end of file
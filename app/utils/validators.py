@@ -1,29 +1,66 @@
-import re
+import string
+from functools import lru_cache
 
+# Допустимые символы частей email: локальной части, домена и зоны
+_EMAIL_LOCAL_CHARS = (string.ascii_letters + string.digits + '._%+-').encode()
+_EMAIL_DOMAIN_CHARS = (string.ascii_letters + string.digits + '.-').encode()
+_EMAIL_ZONE_CHARS = string.ascii_letters.encode()
+_PASSWORD_MAX_LENGTH = 1024
+# Классы символов пароля: проверка isdisjoint проходит строку на C без запуска regex
+_PWD_UPPER = frozenset(string.ascii_uppercase)
+_PWD_LOWER = frozenset(string.ascii_lowercase)
+
+@lru_cache(maxsize=2048)
 def validate_email(email: str) -> bool:
-    """Проверяет валидность email"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
+    """Проверяет валидность email вида local@domain.zone"""
+    # Длина по RFC 5321
+    if not 3 <= len(email) <= 254:
+        return False
+    # Как $ в регулярном выражении: допускается один завершающий перевод строки
+    if email[-1] == '\n':
+        email = email[:-1]
+    try:
+        data = email.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    
+    local, at, domain = data.partition(b'@')
+    domain, dot, zone = domain.rpartition(b'.')
+    # translate удаляет допустимые символы на C: непустой остаток - недопустимый символ
+    return bool(
+        at and dot and local and domain and len(zone) >= 2
+        and not local.translate(None, _EMAIL_LOCAL_CHARS)
+        and not domain.translate(None, _EMAIL_DOMAIN_CHARS)
+        and not zone.translate(None, _EMAIL_ZONE_CHARS)
+    )
 
+@lru_cache(maxsize=2048)
 def validate_username(username: str) -> bool:
-    """Проверяет валидность имени пользователя"""
-    # Только буквы, цифры и подчеркивание, от 3 до 20 символов
-    pattern = r'^[a-zA-Z0-9_]{3,20}$'
-    return bool(re.match(pattern, username))
+    """Проверяет валидность имени пользователя: только буквы, цифры и подчеркивание, от 3 до 20 символов"""
+    # Как $ в регулярном выражении: допускается один завершающий перевод строки
+    if username[-1:] == '\n':
+        username = username[:-1]
+    if not 3 <= len(username) <= 20 or not username.isascii():
+        return False
+    # Строковые методы на C вместо regex: без подчеркиваний должны остаться только латиница и цифры
+    stripped = username.replace('_', '')
+    return not stripped or stripped.isalnum()
 
 def validate_password(password: str) -> bool:
-    """Проверяет сложность пароля"""
-    # Минимум 8 символов, хотя бы одна цифра, одна буква в верхнем и нижнем регистре
-    if len(password) < 8:
+    """Проверяет сложность пароля (без кэша: пароли в открытом виде не хранятся в памяти процесса)"""
+    # От 8 до 1024 символов (верхняя граница ограничивает работу на огромных строках),
+    # хотя бы одна цифра, одна буква в верхнем и нижнем регистре
+    if not 8 <= len(password) <= _PASSWORD_MAX_LENGTH:
         return False
     
-    if not re.search(r'\d', password):
+    # isdecimal совпадает с \d для str: цифры любых алфавитов
+    if not any(map(str.isdecimal, password)):
         return False
     
-    if not re.search(r'[A-Z]', password):
+    if _PWD_UPPER.isdisjoint(password):
         return False
     
-    if not re.search(r'[a-z]', password):
+    if _PWD_LOWER.isdisjoint(password):
         return False
     
     return True
@@ -1,10 +1,19 @@
 import uvicorn
+from app.config import settings
 
 if __name__ == "__main__":
     uvicorn.run(
         "app.main:app",
         host="localhost",
         port=8000,
-        reload=True
+        loop="uvloop",
+        http="httptools",
+        # Лишние запросы сразу получают 503, а не ждут соединения из пула
+        limit_concurrency=settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW,
+        backlog=2048,
+        timeout_keep_alive=5,
+        # Автоперезагрузка работает только с одним процессом
+        workers=settings.WORKERS,
+        reload=settings.DEBUG and settings.WORKERS == 1
     )
 